@@ -28,8 +28,12 @@ setup(
         'setuptools',
         'Flask',
         'Flask-Mako',
-        'lxml'
+        'lxml',
+        'numpy',
     ],
+    extras_require={
+        'thumbnails': ['Pillow'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
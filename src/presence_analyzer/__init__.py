@@ -1,6 +1,35 @@
 # -*- coding: utf-8 -*-
 """
 Presence analyzer.
+
+Heavy imports are timed here, before anything else of the package is
+loaded, so IMPORT_TIMES holds cold import times reported by warm-up.
 """
-from .main import app
-from . import views
+import time
+from importlib import import_module
+
+HEAVY_MODULES = ('numpy', 'lxml.etree', 'flask', 'flask_mako')
+PACKAGE_MODULES = ('.main', '.views', '.hot')
+
+
+def time_imports():
+    """
+    Imports heavy modules one by one, then modules of the package.
+
+    Returns (stage, seconds) pairs, modules of the package are timed as
+    one stage.
+    """
+    timings = []
+    for name in HEAVY_MODULES:
+        start = time.time()
+        import_module(name)
+        timings.append(('import ' + name, time.time() - start))
+    start = time.time()
+    for name in PACKAGE_MODULES:
+        import_module(name, __name__)
+    timings.append(('import presence_analyzer', time.time() - start))
+    return timings
+
+
+IMPORT_TIMES = time_imports()
+app = import_module('.main', __name__).app  # pylint: disable=invalid-name
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control of heavy API requests.
+"""
+
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from json import dumps
+
+from flask import Response, copy_current_request_context, request
+
+from presence_analyzer import utils
+from presence_analyzer.main import app
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+STALE_RESULTS = OrderedDict()
+STALE_RESULTS_LOCK = threading.Lock()
+
+
+class AdmissionController(object):
+    """
+    Limits number of running computations and of requests waiting for one.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active = 0
+        self.queued = 0
+
+    def acquire(self, max_active, max_queued, timeout):
+        """
+        Takes a computation slot, waits up to `timeout` seconds in the queue.
+
+        Returns False immediately when the queue is full and after the
+        timeout when no slot was freed.
+        """
+        with self.condition:
+            if self.active < max_active:
+                self.active += 1
+                return True
+            if self.queued >= max_queued:
+                return False
+            self.queued += 1
+            try:
+                deadline = time.time() + timeout
+                while self.active >= max_active:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        """
+        Frees a computation slot and wakes up one waiting request.
+        """
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+ADMISSION = AdmissionController()
+
+
+def remember_result(key, response):
+    """
+    Keeps successful response for stale_response().
+
+    At most ADMISSION_STALE_SIZE least recently used responses are kept.
+    """
+    with STALE_RESULTS_LOCK:
+        STALE_RESULTS.pop(key, None)
+        STALE_RESULTS[key] = (response.get_data(), response.mimetype)
+        while len(STALE_RESULTS) > app.config.get(
+                'ADMISSION_STALE_SIZE', 1024):
+            STALE_RESULTS.popitem(last=False)
+
+
+def stale_response(key):
+    """
+    Returns last successful response of a view marked as stale, None if
+    there is none.
+    """
+    with STALE_RESULTS_LOCK:
+        if key not in STALE_RESULTS:
+            return None
+        STALE_RESULTS[key] = STALE_RESULTS.pop(key)
+        data, mimetype = STALE_RESULTS[key]
+    return Response(
+        data,
+        mimetype=mimetype,
+        headers={'Warning': '110 - "Response is Stale"'}
+    )
+
+
+def overloaded_response():
+    """
+    Returns 503 response asking the client to retry later.
+    """
+    retry_after = app.config.get('ADMISSION_RETRY_AFTER', 5)
+    return Response(
+        dumps({'message': 'Server is overloaded!', 'status': 503}),
+        status=503,
+        mimetype='application/json',
+        headers={'Retry-After': str(retry_after)}
+    )
+
+
+def admission(function=None, query_args=()):
+    """
+    Decorator limiting concurrent computations of heavy views.
+
+    At most ADMISSION_MAX_ACTIVE computations run at once and at most
+    ADMISSION_MAX_QUEUED requests wait for a slot, others get 503 with
+    Retry-After. When a result is not ready within REQUEST_DEADLINE seconds
+    the last successful response is served instead, the computation goes
+    on in background and refreshes it.
+
+    Responses are told apart by view arguments and by `query_args`, names
+    of query arguments read by the view, other query arguments are ignored.
+    """
+    if function is None:
+        return lambda function: admission(function, query_args)
+
+    @wraps(function)
+    def inner(*args, **kwargs):  # pylint: disable=missing-docstring
+        key = (
+            function.__name__,
+            args,
+            tuple(sorted(kwargs.items())),
+            tuple(tuple(request.args.getlist(name)) for name in query_args),
+            utils.current_dataset(),
+        )
+        deadline = time.time() + app.config.get('REQUEST_DEADLINE', 10)
+        admitted = ADMISSION.acquire(
+            app.config.get('ADMISSION_MAX_ACTIVE', 8),
+            app.config.get('ADMISSION_MAX_QUEUED', 32),
+            deadline - time.time()
+        )
+        if not admitted:
+            log.warning('Request to %s rejected', function.__name__)
+            stale = stale_response(key)
+            return overloaded_response() if stale is None else stale
+
+        outcome = {}
+        done = threading.Event()
+
+        @copy_current_request_context
+        def compute():  # pylint: disable=missing-docstring
+            try:
+                response = function(*args, **kwargs)
+                if response.status_code == 200:
+                    remember_result(key, response)
+                outcome['response'] = response
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Computing %s failed', function.__name__)
+                outcome['error'] = sys.exc_info()
+            finally:
+                ADMISSION.release()
+                done.set()
+
+        stale = stale_response(key)
+        if stale is None:
+            compute()
+        else:
+            thread = threading.Thread(target=compute)
+            thread.daemon = True
+            thread.start()
+            if not done.wait(max(deadline - time.time(), 0)):
+                log.warning('Deadline of %s exceeded', function.__name__)
+                return stale
+
+        if 'error' in outcome:
+            raise outcome['error'][0], outcome['error'][1], outcome['error'][2]
+        return outcome['response']
+    inner.query_args = query_args
+    return inner
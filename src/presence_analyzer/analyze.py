@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Batch analytics of all users.
+"""
+
+import json
+import logging
+import multiprocessing
+from datetime import datetime, timedelta
+
+from presence_analyzer import utils
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+WORKDAY_SECONDS = 8 * 3600
+LATE_ARRIVAL_SECONDS = 10 * 3600
+
+
+def analyze_user(items):
+    """
+    Computes overtime, late arrivals and missing days of a single user.
+
+    Missing days are working days between first and last presence of the
+    user without any entry.
+    """
+    weekdays = utils.group_by_weekday(items)
+    overtime = [
+        presence - WORKDAY_SECONDS
+        for intervals in weekdays
+        for presence in intervals
+        if presence > WORKDAY_SECONDS
+    ]
+    late_arrivals = sum(
+        1
+        for start_end in utils.group_start_end_by_weekday(items)
+        for start in start_end['start']
+        if start > LATE_ARRIVAL_SECONDS
+    )
+    missing_days = []
+    if items:
+        day, last = min(items), max(items)
+        while day <= last:
+            if day.weekday() < 5 and day not in items:
+                missing_days.append(day.isoformat())
+            day += timedelta(days=1)
+    return {
+        'days': len(items),
+        'overtime_days': len(overtime),
+        'overtime_hours': round(sum(overtime) / 3600.0, 2),
+        'late_arrivals': late_arrivals,
+        'missing_days': missing_days,
+    }
+
+
+def analyze_chunk(chunk):
+    """
+    Analyzes a list of (user_id, items) pairs, runs in a pool worker.
+    """
+    return [(user_id, analyze_user(items)) for user_id, items in chunk]
+
+
+def analyze(data, workers=None, chunk_size=10, progress=None):
+    """
+    Analyzes all users partitioned across a pool of worker processes.
+
+    `workers` defaults to the number of CPUs, a single worker runs in this
+    process. `progress` is called with numbers of done and all users.
+    """
+    users = sorted(data.iteritems())
+    chunks = [
+        users[i:i + chunk_size] for i in xrange(0, len(users), chunk_size)
+    ]
+    workers = workers or multiprocessing.cpu_count()
+    results = {}
+    if workers == 1:
+        completed = (analyze_chunk(chunk) for chunk in chunks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        completed = pool.imap_unordered(analyze_chunk, chunks)
+    try:
+        for reports in completed:
+            results.update(reports)
+            if progress:
+                progress(len(results), len(users))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return results
+
+
+def write_report(path, results):
+    """
+    Writes consolidated report of all users as JSON.
+    """
+    utils.atomic_write(path, json.dumps({
+        'generated': datetime.now().isoformat(),
+        'users': results,
+    }, indent=2, sort_keys=True))
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of user avatars fetched from the intranet.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import urllib2
+from cStringIO import StringIO
+
+from presence_analyzer import utils
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+THUMBNAIL_SIZE = (64, 64)
+FETCH_LOCKS = {}
+FETCH_LOCKS_LOCK = threading.Lock()
+CAP_LOCK = threading.Lock()
+IMAGE_TYPES = (
+    ('\x89PNG', 'image/png'),
+    ('\xff\xd8', 'image/jpeg'),
+    ('GIF8', 'image/gif'),
+)
+
+
+def image_mimetype(content):
+    """
+    Detects image type by its magic bytes.
+    """
+    for magic, mimetype in IMAGE_TYPES:
+        if content.startswith(magic):
+            return mimetype
+    return 'application/octet-stream'
+
+
+def make_thumbnail(content):
+    """
+    Scales image down to THUMBNAIL_SIZE and encodes it as PNG.
+
+    Returns content unchanged when Pillow is not installed or the image
+    cannot be decoded.
+    """
+    if Image is None:
+        return content
+    try:
+        image = Image.open(StringIO(content))
+        image.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
+        thumbnail = StringIO()
+        image.save(thumbnail, 'PNG')
+    except (IOError, ValueError):
+        log.warning('Cannot make thumbnail', exc_info=True)
+        return content
+    return thumbnail.getvalue()
+
+
+def enforce_size_cap(cache_dir, max_bytes):
+    """
+    Removes least recently used avatars until cache fits in max_bytes.
+
+    Files being written by other fetches are left alone.
+    """
+    with CAP_LOCK:
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.startswith(utils.TMP_PREFIX):
+                continue
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def fetch_lock(name):
+    """
+    Returns lock of a single avatar, so only one thread fetches it while
+    other avatars are fetched in parallel.
+    """
+    with FETCH_LOCKS_LOCK:
+        return FETCH_LOCKS.setdefault(name, threading.Lock())
+
+
+def read_avatar(path):
+    """
+    Returns cached avatar and refreshes its modification time, None if it
+    is not cached.
+    """
+    try:
+        os.utime(path, None)
+        with open(path, 'rb') as avatar_file:
+            return avatar_file.read()
+    except (IOError, OSError):
+        return None
+
+
+def fetch_avatar(url, timeout):
+    """
+    Downloads avatar and scales it down.
+    """
+    log.debug('Fetching avatar %s', url)
+    response = urllib2.urlopen(url, timeout=timeout)
+    try:
+        return make_thumbnail(response.read())
+    finally:
+        response.close()
+
+
+def get_avatar(url, cache_dir, max_bytes, timeout=10):
+    """
+    Returns thumbnail of avatar at given URL, fetches it on first use.
+
+    Avatars are cached under a hash of their URL, so a changed avatar is
+    fetched again. Cache hits refresh file modification time which drives
+    LRU eviction. Raises IOError when the avatar cannot be fetched.
+    """
+    name = hashlib.sha1(url).hexdigest()
+    path = os.path.join(cache_dir, '{}.avatar'.format(name))
+    content = read_avatar(path)
+    if content is not None:
+        return content
+    try:
+        with fetch_lock(name):
+            content = read_avatar(path)
+            if content is None:
+                content = fetch_avatar(url, timeout)
+                if not os.path.isdir(cache_dir):
+                    try:
+                        os.makedirs(cache_dir)
+                    except OSError:
+                        if not os.path.isdir(cache_dir):
+                            raise
+                utils.atomic_write(path, content)
+                enforce_size_cap(cache_dir, max_bytes)
+    finally:
+        with FETCH_LOCKS_LOCK:
+            FETCH_LOCKS.pop(name, None)
+    return content
+
+
+def avatar_etag(content):
+    """
+    Returns ETag of avatar content.
+    """
+    return hashlib.sha1(content).hexdigest()
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends of the caching decorator.
+"""
+
+import cPickle as pickle
+import logging
+import math
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MEMCACHED_MAX_EXPIRY = 30 * 24 * 3600
+
+
+class CacheBackend(object):
+    """
+    Base of cache backends.
+
+    Backend errors are logged and counted, a failing backend behaves like
+    an empty cache instead of breaking the request.
+    """
+    errors = ()
+
+    def __init__(self):
+        self.stats = {
+            'hits': 0, 'misses': 0, 'stale': 0, 'sets': 0, 'errors': 0
+        }
+
+    def get(self, key):
+        """
+        Returns cache entry stored under key or None.
+        """
+        try:
+            return self.load(key)
+        except self.errors:  # pylint: disable=catching-non-exception
+            log.warning('Cache backend %s failed', self, exc_info=True)
+            self.stats['errors'] += 1
+            return None
+
+    def set(self, key, entry, duration):
+        """
+        Stores cache entry for `duration` milliseconds.
+        """
+        try:
+            self.save(key, entry, duration)
+            self.stats['sets'] += 1
+        except self.errors:  # pylint: disable=catching-non-exception
+            log.warning('Cache backend %s failed', self, exc_info=True)
+            self.stats['errors'] += 1
+
+    def load(self, key):
+        """
+        Reads entry from the storage.
+        """
+        raise NotImplementedError
+
+    def save(self, key, entry, duration):
+        """
+        Writes entry to the storage.
+        """
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Keeps entries in a dict private to the process.
+
+    `store` returns the dict, entries are kept as they are, not pickled.
+    """
+
+    def __init__(self, store):
+        super(MemoryCacheBackend, self).__init__()
+        self.store = store
+
+    def __repr__(self):
+        return 'memory'
+
+    def load(self, key):
+        return self.store().get(key)
+
+    def save(self, key, entry, duration):
+        self.store()[key] = entry
+
+
+class SqliteCacheBackend(CacheBackend):
+    """
+    Keeps pickled entries in a SQLite file shared by all processes.
+    """
+    errors = (sqlite3.Error, pickle.UnpicklingError, EOFError)
+
+    def __init__(self, path):
+        super(SqliteCacheBackend, self).__init__()
+        self.path = path
+        with closing(self.connect()) as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value BLOB, expires REAL)'
+            )
+            connection.commit()
+
+    def __repr__(self):
+        return 'sqlite://{}'.format(self.path)
+
+    def connect(self):
+        """
+        Opens a new connection, connections are not shared between threads.
+        """
+        return sqlite3.connect(self.path, timeout=10)
+
+    def load(self, key):
+        with closing(self.connect()) as connection:
+            row = connection.execute(
+                'SELECT value FROM cache WHERE key = ? AND expires > ?',
+                (key, time.time())
+            ).fetchone()
+        return pickle.loads(str(row[0])) if row else None
+
+    def save(self, key, entry, duration):
+        with closing(self.connect()) as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                (
+                    key,
+                    sqlite3.Binary(
+                        pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+                    ),
+                    time.time() + duration / 1000.0,
+                )
+            )
+            connection.commit()
+
+
+class MemcachedCacheBackend(CacheBackend):
+    """
+    Keeps pickled entries in a server speaking memcached text protocol.
+
+    Every thread keeps its own connection.
+    """
+    errors = (socket.error, IOError, ValueError, pickle.UnpicklingError)
+
+    def __init__(self, host, port, timeout=1.0):
+        super(MemcachedCacheBackend, self).__init__()
+        self.address = (host, port)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __repr__(self):
+        return 'memcached://{}:{}'.format(*self.address)
+
+    def connection(self):
+        """
+        Returns socket and its reader, connects if needed.
+        """
+        if getattr(self.local, 'socket', None) is None:
+            self.local.socket = socket.create_connection(
+                self.address, self.timeout
+            )
+            self.local.reader = self.local.socket.makefile('rb')
+        return self.local.socket, self.local.reader
+
+    def disconnect(self):
+        """
+        Drops connection of current thread after a protocol error.
+        """
+        if getattr(self.local, 'socket', None) is not None:
+            self.local.reader.close()
+            self.local.socket.close()
+        self.local.socket = self.local.reader = None
+
+    def load(self, key):
+        try:
+            connection, reader = self.connection()
+            connection.sendall('get {}\r\n'.format(key))
+            header = reader.readline()
+            if header == 'END\r\n':
+                return None
+            parts = header.split()
+            if len(parts) != 4 or parts[0] != 'VALUE':
+                raise ValueError('Unexpected response {!r}'.format(header))
+            value = reader.read(int(parts[3]) + 2)[:-2]
+            if reader.readline() != 'END\r\n':
+                raise ValueError('Missing END of {}'.format(key))
+            return pickle.loads(value)
+        except self.errors:
+            self.disconnect()
+            raise
+
+    def save(self, key, entry, duration):
+        value = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        expiry = min(
+            int(math.ceil(duration / 1000.0)), MEMCACHED_MAX_EXPIRY
+        )
+        try:
+            connection, reader = self.connection()
+            connection.sendall('set {} 0 {} {}\r\n{}\r\n'.format(
+                key, expiry, len(value), value
+            ))
+            response = reader.readline()
+            if response != 'STORED\r\n':
+                raise ValueError('Unexpected response {!r}'.format(response))
+        except self.errors:
+            self.disconnect()
+            raise
+
+
+def create_backend(url, memory_store):
+    """
+    Creates backend from URL: `memory`, `sqlite://<path>` or
+    `memcached://<host>:<port>`.
+    """
+    if url == 'memory':
+        return MemoryCacheBackend(memory_store)
+    if url.startswith('sqlite://'):
+        return SqliteCacheBackend(url[len('sqlite://'):])
+    if url.startswith('memcached://'):
+        host, _, port = url[len('memcached://'):].partition(':')
+        return MemcachedCacheBackend(host, int(port or 11211))
+    raise ValueError('Unknown cache backend {}'.format(url))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Named datasets served by one application under /api/v1/<dataset>/.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+from werkzeug.routing import BaseConverter, ValidationError
+
+from presence_analyzer import utils
+from presence_analyzer.main import app
+from presence_analyzer.memory import deep_size
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+API_PREFIX = '/api/v1/'
+ACTIVE_ENVIRON_KEY = 'presence_analyzer.dataset_active'
+PROCESS_ENDPOINTS = {'cache_stats_view', 'events_view', 'memory_view'}
+USAGE = OrderedDict()
+USAGE_LOCK = threading.Lock()
+MEASUREMENTS = {}
+
+
+class DatasetConverter(BaseConverter):
+    """
+    Matches names of datasets configured by DATASETS setting.
+    """
+
+    def to_python(self, value):
+        if value not in app.config.get('DATASETS', {}):
+            raise ValidationError()
+        return value
+
+
+app.url_map.converters['dataset'] = DatasetConverter
+
+
+def add_dataset_rules(application):
+    """
+    Serves every API view of data also under /api/v1/<dataset>/ prefix.
+
+    Views reporting state of the whole process are left out.
+    """
+    for rule in list(application.url_map.iter_rules()):
+        if not rule.rule.startswith(API_PREFIX) or \
+                rule.endpoint in PROCESS_ENDPOINTS:
+            continue
+        application.add_url_rule(
+            API_PREFIX + '<dataset:dataset>/' + rule.rule[len(API_PREFIX):],
+            rule.endpoint,
+            methods=rule.methods
+        )
+
+
+@app.url_value_preprocessor
+def pull_dataset(endpoint, values):  # pylint: disable=unused-argument
+    """
+    Moves dataset name from view arguments to the WSGI environment and
+    marks the dataset in use until the request is torn down.
+
+    Environment is shared by copies of the request context, so the name
+    is also seen by computations running in background threads.
+    """
+    if values and 'dataset' in values:
+        dataset = values.pop('dataset')
+        request.environ[utils.DATASET_ENVIRON_KEY] = dataset
+        request.environ[ACTIVE_ENVIRON_KEY] = True
+        use_dataset(dataset, 1)
+
+
+@app.teardown_request
+def release_dataset(exception):  # pylint: disable=unused-argument
+    """
+    Marks dataset of the request no longer in use.
+
+    Copies of the request context are torn down too, the mark is removed
+    from the shared environment so only the first one releases it.
+    """
+    if request.environ.pop(ACTIVE_ENVIRON_KEY, False):
+        use_dataset(utils.current_dataset(), -1)
+
+
+@app.url_defaults
+def add_dataset(endpoint, values):
+    """
+    Builds URLs within the dataset of the current request.
+    """
+    dataset = utils.current_dataset()
+    if dataset is not None and 'dataset' not in values and \
+            app.url_map.is_endpoint_expecting(endpoint, 'dataset'):
+        values['dataset'] = dataset
+
+
+@app.after_request
+def account_dataset(response):
+    """
+    Records use of named dataset and keeps datasets within memory budget.
+    """
+    dataset = utils.current_dataset()
+    if dataset is not None:
+        touch_dataset(dataset)
+        evict_datasets(
+            app.config.get('DATASETS_MEMORY_BUDGET', 512 * 1024 * 1024),
+            app.config.get('DATASETS_IDLE_TIME', 60),
+            dataset
+        )
+    return response
+
+
+def new_usage():
+    """
+    Returns usage record of a dataset not seen before.
+    """
+    return {'fingerprint': None, 'bytes': 0, 'used': time.time(), 'active': 0}
+
+
+def use_dataset(dataset, delta):
+    """
+    Counts requests in flight of a dataset, it is not evicted while there
+    are any.
+    """
+    with USAGE_LOCK:
+        usage = USAGE.setdefault(dataset, new_usage())
+        usage['active'] += delta
+        usage['used'] = time.time()
+
+
+def dataset_size(dataset):
+    """
+    Returns bytes taken by cache entries and INDEXES of given dataset.
+    """
+    seen = set()
+    size = deep_size(utils.INDEXES.get(dataset, {}), seen)
+    for entry in utils.CACHE.values():
+        if entry.get('dataset') == dataset:
+            size += deep_size(entry, seen)
+    return size
+
+
+def measure_dataset(dataset, fingerprint):
+    """
+    Records size of a dataset, runs in a background thread.
+    """
+    try:
+        size = dataset_size(dataset)
+        with USAGE_LOCK:
+            usage = USAGE.get(dataset)
+            if usage is not None:
+                usage['bytes'] = size
+                usage['fingerprint'] = fingerprint
+    except Exception:  # pylint: disable=broad-except
+        log.exception('Measuring dataset %s failed', dataset)
+    finally:
+        with USAGE_LOCK:
+            del MEASUREMENTS[dataset]
+
+
+def start_measurement(dataset, fingerprint):
+    """
+    Starts measuring a dataset in background unless it is being measured.
+    """
+    with USAGE_LOCK:
+        if dataset in MEASUREMENTS:
+            return
+        thread = MEASUREMENTS[dataset] = threading.Thread(
+            target=measure_dataset, args=(dataset, fingerprint)
+        )
+        thread.daemon = True
+        thread.start()
+
+
+def touch_dataset(dataset):
+    """
+    Marks dataset as recently used and measures it after it was (re)loaded.
+
+    Size is measured again only when its cache entries change. Walking
+    all of them takes long, so it is done in background and the previous
+    size is used meanwhile.
+    """
+    fingerprint = (
+        sorted(
+            (key, entry['time'])
+            for key, entry in utils.CACHE.items()
+            if entry.get('dataset') == dataset
+        ),
+        id(utils.INDEXES.get(dataset)),
+    )
+    with USAGE_LOCK:
+        usage = USAGE.pop(dataset, None) or new_usage()
+        usage['used'] = time.time()
+        USAGE[dataset] = usage
+    if usage['fingerprint'] != fingerprint:
+        start_measurement(dataset, fingerprint)
+
+
+def evict_datasets(budget, idle_time, current=None):
+    """
+    Evicts least recently used idle datasets while over memory budget.
+
+    Datasets used within last `idle_time` seconds, those with requests in
+    flight and the `current` one are kept. Returns names of evicted
+    datasets.
+    """
+    evicted = []
+    with USAGE_LOCK:
+        total = sum(usage['bytes'] for usage in USAGE.itervalues())
+        for dataset, usage in USAGE.items():
+            if total <= budget:
+                break
+            if dataset == current or usage['active'] or \
+                    time.time() - usage['used'] < idle_time:
+                continue
+            utils.evict_dataset(dataset)
+            del USAGE[dataset]
+            total -= usage['bytes']
+            evicted.append(dataset)
+    for dataset in evicted:
+        log.info('Dataset %s evicted from memory', dataset)
+    return evicted
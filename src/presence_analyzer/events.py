@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Notifications about new generations of data files.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from presence_analyzer import hot, utils
+from presence_analyzer.main import app
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class ChangeNotifier(object):
+    """
+    Watches data sources and wakes up all waiting clients on a change.
+
+    `sources` maps event name to a pair of callables: one returning
+    generation token of the source, the other reloading it. A single
+    background thread checks the tokens, clients only wait on a condition.
+    Events carry a counter of changes of the source, not its token.
+    """
+
+    def __init__(self, sources, history=16):
+        self.sources = sources
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.events = deque(maxlen=history)
+        self.generations = {}
+        self.changes = {}
+        self.streams = 0
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def start(self, interval):
+        """
+        Starts watching thread unless it is already running.
+        """
+        with self.thread_lock:
+            if self.thread is not None:
+                return
+            self.generations = {
+                name: generation()
+                for name, (generation, _) in self.sources.iteritems()
+            }
+            self.thread = threading.Thread(
+                target=self.watch, args=(interval,), name='change-notifier'
+            )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def watch(self, interval):
+        """
+        Checks sources every `interval` seconds, runs in the thread.
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                self.check()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Checking data generations failed')
+
+    def check(self):
+        """
+        Reloads changed sources and publishes their events.
+        """
+        for name, (generation, reload_source) in sorted(
+                self.sources.iteritems()):
+            current = generation()
+            if self.generations.get(name) == current:
+                continue
+            reload_source()
+            self.generations[name] = current
+            self.changes[name] = self.changes.get(name, 0) + 1
+            self.publish(name, self.changes[name])
+
+    def publish(self, name, generation):
+        """
+        Records an event and wakes up all waiting clients.
+        """
+        with self.condition:
+            self.sequence += 1
+            self.events.append((self.sequence, name, generation))
+            self.condition.notify_all()
+
+    def open_stream(self, max_streams):
+        """
+        Counts a new client stream, returns False if `max_streams` are
+        already open.
+        """
+        with self.condition:
+            if self.streams >= max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        """
+        Counts a closed client stream.
+        """
+        with self.condition:
+            self.streams -= 1
+
+    def wait(self, seen, timeout):
+        """
+        Returns events newer than `seen` sequence, waits up to `timeout`
+        seconds for them. Returns an empty list on timeout.
+        """
+        with self.condition:
+            if self.sequence <= seen:
+                self.condition.wait(timeout)
+            return [event for event in self.events if event[0] > seen]
+
+
+def reloader(load):
+    """
+    Returns callable reloading a source and waiting until results of its
+    new generation are prewarmed.
+
+    Until then requests get results of the previous generation, clients
+    notified earlier would fetch stale data.
+    """
+    def reload_source():  # pylint: disable=missing-docstring
+        load()
+        hot.wait_for_prewarm(utils.current_dataset())
+    return reload_source
+
+
+NOTIFIER = ChangeNotifier({
+    'data': (utils.data_generation, reloader(utils.get_data)),
+    'users': (utils.users_generation, reloader(utils.get_users_from_xml)),
+})
+
+
+def get_notifier():
+    """
+    Returns the process-wide notifier, started on first use.
+    """
+    NOTIFIER.start(app.config.get('EVENTS_POLL_INTERVAL', 5))
+    return NOTIFIER
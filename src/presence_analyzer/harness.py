@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence and speed-up checks of fast paths against reference helpers.
+"""
+
+import bz2
+import calendar
+import csv
+import gzip
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import time
+from contextlib import closing, contextmanager
+from datetime import date, datetime, timedelta
+
+from presence_analyzer import admission, utils, views
+from presence_analyzer.materialize import api_endpoints
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+FIRST_DAY = date(2013, 9, 2)
+MODES = ('eager', 'lazy', 'gzip', 'bzip2')
+MALFORMED_ROWS = (
+    'abc,2013-09-10,09:00:00,17:00:00',
+    '{user_id},2013-13-40,09:00:00,17:00:00',
+    '{user_id},2013-09-10,25:00:00,17:00:00',
+    '{user_id},2013-09-10,09:00:00',
+    '{user_id},,,',
+    '',
+)
+MIDNIGHT_EDGES = (
+    ('00:00:00', '23:59:59'),
+    ('00:00:00', '00:00:00'),
+    ('23:59:59', '23:59:59'),
+    ('00:00:01', '08:00:00'),
+)
+
+
+def generate_dataset(path, users=20, days=60, seed=0):
+    """
+    Writes randomized presence CSV file, returns ids of generated users.
+
+    Besides regular entries the file has a header, malformed rows,
+    duplicated dates of a user and entries starting or ending at midnight.
+    Rows of users are interleaved.
+    """
+    rng = random.Random(seed)
+    user_ids = rng.sample(xrange(1, 10 * users), users)
+    lines = []
+    for user_id in user_ids:
+        for day in xrange(days):
+            if rng.random() < 0.3:
+                continue
+            current = FIRST_DAY + timedelta(days=day)
+            if rng.random() < 0.05:
+                start, end = rng.choice(MIDNIGHT_EDGES)
+            else:
+                start_seconds = rng.randint(6 * 3600, 11 * 3600)
+                end_seconds = rng.randint(start_seconds, 24 * 3600 - 1)
+                start, end = [
+                    time.strftime('%H:%M:%S', time.gmtime(seconds))
+                    for seconds in (start_seconds, end_seconds)
+                ]
+            lines.append('{},{},{},{}'.format(
+                user_id, current.isoformat(), start, end
+            ))
+            if rng.random() < 0.05:
+                lines.append('{},{},{},{}'.format(
+                    user_id, current.isoformat(), *rng.choice(MIDNIGHT_EDGES)
+                ))
+        for row in rng.sample(MALFORMED_ROWS, 2):
+            lines.append(row.format(user_id=user_id))
+    rng.shuffle(lines)
+    with open(path, 'w') as csv_file:
+        csv_file.write('user_id,date,start,end\n')
+        csv_file.write('\n'.join(lines))
+        csv_file.write('\n')
+    return sorted(user_ids)
+
+
+def reference_data(path):
+    """
+    Reads presence CSV file the plain way, without ingest sinks.
+    """
+    data = {}
+    with open(path, 'r') as csv_file:
+        for row in csv.reader(csv_file, delimiter=','):
+            if len(row) != 4:
+                continue
+            try:
+                user_id = int(row[0])
+                day = datetime.strptime(row[1], '%Y-%m-%d').date()
+                start = datetime.strptime(row[2], '%H:%M:%S').time()
+                end = datetime.strptime(row[3], '%H:%M:%S').time()
+            except (ValueError, TypeError):
+                continue
+            data.setdefault(user_id, {})[day] = {'start': start, 'end': end}
+    return data
+
+
+def reference_quantile(values, fraction):
+    """
+    Returns exact value at given rank fraction, zero for no values.
+
+    Ranks are the same as those of an uncompacted QuantileSketch.
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+def reference_responses(data):
+    """
+    Computes responses of per-user views with the reference helpers.
+    """
+    responses = {}
+    for user_id, items in data.iteritems():
+        weekdays = utils.group_by_weekday(items)
+        start_end = utils.group_start_end_by_weekday(items)
+        means = [utils.mean(intervals) for intervals in weekdays]
+        responses['/api/v1/mean_time_weekday/{}'.format(user_id)] = [
+            [calendar.day_abbr[weekday], value]
+            for weekday, value in enumerate(means)
+        ]
+        responses['/api/v1/presence_weekday/{}'.format(user_id)] = [
+            ['Weekday', 'Presence (s)']
+        ] + [
+            [calendar.day_abbr[weekday], sum(intervals)]
+            for weekday, intervals in enumerate(weekdays)
+        ]
+        responses['/api/v1/presence_start_end/{}'.format(user_id)] = [
+            [
+                calendar.day_abbr[weekday],
+                utils.mean(times['start']),
+                utils.mean(times['end']),
+            ]
+            for weekday, times in enumerate(start_end)
+        ]
+        responses[
+            '/api/v1/presence_start_end_percentiles/{}'.format(user_id)
+        ] = [list(views.PERCENTILES_HEADER)] + [
+            [calendar.day_abbr[weekday]] + [
+                reference_quantile(times[name], fraction)
+                for fraction in (0.5, 0.9)
+                for name in ('start', 'end')
+            ]
+            for weekday, times in enumerate(start_end)
+        ]
+        worked_hours, off_hours = utils.sum_intervals(means)
+        responses['/api/v1/weekly_mean_presence/{}'.format(user_id)] = [
+            ['Activity', 'Total hours'],
+            ['Worked hours', worked_hours],
+            ['Off hours', off_hours],
+        ]
+    return responses
+
+
+def api_paths(app, user_ids):
+    """
+    Returns paths of all data API views for given users.
+
+    An unknown user and moments around midnight are included too.
+    """
+    paths = []
+    for endpoint, per_user in api_endpoints(app, query_views=True):
+        rule = next(
+            rule for rule in app.url_map.iter_rules(endpoint)
+            if 'dataset' not in rule.arguments
+        )
+        if per_user:
+            paths.extend(
+                rule.rule.replace('<int:user_id>', str(user_id))
+                for user_id in list(user_ids) + [0]
+            )
+        else:
+            paths.append(rule.rule)
+    paths.extend(
+        '/api/v1/occupancy/{}'.format(moment)
+        for moment in ('2013-09-10T00:00', '2013-09-10T12:00',
+                       '2013-09-15T23:59', 'invalid')
+    )
+    return sorted(paths)
+
+
+@contextmanager
+def configured(app, settings):
+    """
+    Overrides application settings, restores the original ones on exit.
+    """
+    missing = object()
+    original = {name: app.config.get(name, missing) for name in settings}
+    app.config.update(settings)
+    try:
+        yield
+    finally:
+        for name, value in original.iteritems():
+            if value is missing:
+                app.config.pop(name, None)
+            else:
+                app.config[name] = value
+
+
+def clear_state():
+    """
+    Drops cached results, indexes and stale responses of all modes.
+    """
+    utils.CACHE.clear()
+    utils.INDEXES.clear()
+    utils.LAZY_USERS.clear()
+    admission.STALE_RESULTS.clear()
+
+
+def collect_responses(app, paths):
+    """
+    Returns JSON responses of given paths as they were sent.
+    """
+    client = app.test_client()
+    return {path: client.get(path).data for path in paths}
+
+
+def prepare_mode(app, mode, path, tmp_dir):
+    """
+    Configures application to read data file in given mode, starting
+    with no state left by the previous one.
+    """
+    clear_state()
+    app.config.update({'DATA_CSV': path, 'LAZY_LOADING': mode == 'lazy'})
+    if mode in ('gzip', 'bzip2'):
+        opener = gzip.open if mode == 'gzip' else bz2.BZ2File
+        compressed = os.path.join(tmp_dir, 'data.csv.' + mode)
+        with open(path, 'rb') as csv_file:
+            with closing(opener(compressed, 'wb')) as compressed_file:
+                shutil.copyfileobj(csv_file, compressed_file)
+        app.config.update({'DATA_CSV': compressed})
+
+
+def check_equivalence(app, path, user_ids, tmp_dir):
+    """
+    Compares JSON responses of every data view across all MODES and with
+    reference helpers. Returns list of (mode, path) mismatches.
+
+    Results are computed in-process, without prewarming, so every mode
+    computes them from its own data file.
+    """
+    settings = {
+        'DATA_CSV': path,
+        'LAZY_LOADING': False,
+        'PREWARM': False,
+        'CACHE_BACKEND': 'memory',
+    }
+    paths = api_paths(app, user_ids)
+    mismatches = []
+    with configured(app, settings):
+        prepare_mode(app, 'eager', path, tmp_dir)
+        expected = collect_responses(app, paths)
+        if utils.get_data() != reference_data(path):
+            mismatches.append(('reference', 'get_data'))
+        for reference_path, response in sorted(
+                reference_responses(reference_data(path)).iteritems()):
+            if json.loads(expected[reference_path]) != response:
+                mismatches.append(('reference', reference_path))
+        for mode in MODES[1:]:
+            prepare_mode(app, mode, path, tmp_dir)
+            responses = collect_responses(app, paths)
+            mismatches.extend(
+                (mode, view_path) for view_path in paths
+                if responses[view_path] != expected[view_path]
+            )
+        clear_state()
+    return mismatches
+
+
+def best_time(function, repeat):
+    """
+    Returns shortest of `repeat` run times of function in seconds.
+    """
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def time_fast_paths(app, path, user_ids, repeat=3):
+    """
+    Times reference and fast path of each computation on the data file.
+
+    Ingest of the fast path includes building of all indexes by get_data(),
+    the reference only reads the file. Means start from a cold cache, so
+    both include reading the file. Returns list of (name, reference
+    seconds, fast path seconds).
+    """
+    settings = {
+        'DATA_CSV': path,
+        'LAZY_LOADING': True,
+        'PREWARM': False,
+        'CACHE_BACKEND': 'memory',
+    }
+    with configured(app, settings):
+        clear_state()
+        utils.get_data()
+        sample = user_ids[:5]
+
+        def ingest():  # pylint: disable=missing-docstring
+            clear_state()
+            utils.get_data()
+
+        def aggregates():  # pylint: disable=missing-docstring
+            clear_state()
+            return utils.get_weekday_aggregates().itervalues()
+
+        def load_users():  # pylint: disable=missing-docstring
+            utils.LAZY_USERS.clear()
+            for user_id in sample:
+                utils.load_user(user_id)
+
+        def reference_users():  # pylint: disable=missing-docstring
+            data = reference_data(path)
+            return [data.get(user_id) for user_id in sample]
+
+        timings = [
+            (
+                'ingest',
+                best_time(lambda: reference_data(path), repeat),
+                best_time(ingest, repeat),
+            ),
+            (
+                'weekday means',
+                best_time(lambda: [
+                    [utils.mean(intervals)
+                     for intervals in utils.group_by_weekday(items)]
+                    for items in reference_data(path).itervalues()
+                ], repeat),
+                best_time(lambda: [
+                    utils.weekday_means(weekdays, 'presence')
+                    for weekdays in aggregates()
+                ], repeat),
+            ),
+            (
+                'start-end means',
+                best_time(lambda: [
+                    [
+                        (utils.mean(times['start']),
+                         utils.mean(times['end']))
+                        for times in
+                        utils.group_start_end_by_weekday(items)
+                    ]
+                    for items in reference_data(path).itervalues()
+                ], repeat),
+                best_time(lambda: [
+                    zip(utils.weekday_means(weekdays, 'start'),
+                        utils.weekday_means(weekdays, 'end'))
+                    for weekdays in aggregates()
+                ], repeat),
+            ),
+        ]
+        ingest()
+        load_users()
+        timings.append((
+            'single user load',
+            best_time(reference_users, repeat),
+            best_time(load_users, repeat),
+        ))
+        clear_state()
+    return timings
+
+
+def slow_paths(timings, min_speedup):
+    """
+    Returns names of fast paths not faster than reference `min_speedup`
+    times.
+    """
+    return [
+        name for name, reference, fast in timings
+        if reference < min_speedup * fast
+    ]
+
+
+def verify(app, tmp_dir, users=20, days=60, seed=0, min_speedup=1.0):
+    """
+    Generates a dataset and checks equivalence and speed-ups of fast paths.
+
+    Returns report with mismatches, timings and slow fast paths, it passes
+    when both lists are empty.
+    """
+    path = os.path.join(tmp_dir, 'data.csv')
+    user_ids = generate_dataset(path, users, days, seed)
+    mismatches = check_equivalence(app, path, user_ids, tmp_dir)
+    timings = time_fast_paths(app, path, user_ids)
+    for name, reference, fast in timings:
+        log.info(
+            '%-20s reference %9.2f ms, fast path %9.2f ms, %6.1fx',
+            name, reference * 1000, fast * 1000,
+            reference / fast if fast else float('inf')
+        )
+    return {
+        'seed': seed,
+        'mismatches': mismatches,
+        'timings': timings,
+        'slow': slow_paths(timings, min_speedup),
+    }
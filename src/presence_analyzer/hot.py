@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Tracking of frequently viewed users and prewarming of their results.
+"""
+
+import json
+import logging
+import threading
+import time
+
+from flask import request, url_for
+from werkzeug.routing import BuildError
+
+from presence_analyzer import utils
+from presence_analyzer.main import app
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SKIPPED_ENDPOINTS = {'avatar_view'}
+PREWARMS = {}
+PREWARMED = {}
+PREWARM_LOCK = threading.Lock()
+
+
+class HotUsers(object):
+    """
+    Counts requests per (dataset, endpoint, user_id) with decaying counters.
+
+    A counter loses half of its value every `half_life` seconds, so users
+    viewed recently outrank users viewed often long ago.
+    """
+
+    def __init__(self, half_life=3600):
+        self.half_life = half_life
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.saved = time.time()
+
+    def decayed(self, score, updated, now):
+        """
+        Returns score updated at `updated` time decayed until `now`.
+        """
+        return score * 0.5 ** ((now - updated) / float(self.half_life))
+
+    def record(self, key, now=None):
+        """
+        Counts a single request of given key.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            score, updated = self.counters.get(key, (0.0, now))
+            self.counters[key] = (self.decayed(score, updated, now) + 1, now)
+
+    def trim(self, size, now=None):
+        """
+        Keeps only `size` counters of highest decayed scores.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if len(self.counters) <= size:
+                return
+            scores = sorted(
+                (self.decayed(score, updated, now), key)
+                for key, (score, updated) in self.counters.iteritems()
+            )
+            for _, key in scores[:len(self.counters) - size]:
+                del self.counters[key]
+
+    def top(self, count, now=None):
+        """
+        Returns `count` keys of highest decayed scores.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            scores = [
+                (self.decayed(score, updated, now), key)
+                for key, (score, updated) in self.counters.iteritems()
+            ]
+        return [key for _, key in sorted(scores, reverse=True)[:count]]
+
+    def save(self, path):
+        """
+        Writes counters to a JSON file.
+        """
+        with self.lock:
+            counters = [
+                {
+                    'dataset': dataset,
+                    'endpoint': endpoint,
+                    'user_id': user_id,
+                    'score': score,
+                    'updated': updated,
+                }
+                for (dataset, endpoint, user_id), (score, updated)
+                in self.counters.iteritems()
+            ]
+        utils.atomic_write(path, json.dumps(counters))
+        self.saved = time.time()
+
+    def load(self, path):
+        """
+        Reads counters saved by save(), missing or broken file is ignored.
+        """
+        try:
+            with open(path, 'r') as hot_file:
+                counters = json.load(hot_file)
+            loaded = {
+                (counter['dataset'], counter['endpoint'], counter['user_id']):
+                (counter['score'], counter['updated'])
+                for counter in counters
+            }
+        except (IOError, ValueError, KeyError, TypeError):
+            log.debug('No hot users loaded from %s', path)
+            return
+        with self.lock:
+            self.counters.update(loaded)
+
+
+HOT_USERS = HotUsers()
+
+
+@app.after_request
+def record_hot_user(response):
+    """
+    Counts successful requests of per-user views, requests of unknown
+    users are skipped.
+
+    Counters are saved to HOT_USERS_FILE every HOT_USERS_SAVE_INTERVAL
+    seconds, so they survive restarts. Once there are twice as many as
+    HOT_USERS_SIZE, the coldest ones are dropped.
+    """
+    view_args = request.view_args or {}
+    if 'user_id' not in view_args or response.status_code != 200 or \
+            request.endpoint in SKIPPED_ENDPOINTS or utils.is_prewarming() or \
+            request.environ.get(utils.USER_NOT_FOUND_ENVIRON_KEY):
+        return response
+    HOT_USERS.record(
+        (utils.current_dataset(), request.endpoint, view_args['user_id'])
+    )
+    size = app.config.get('HOT_USERS_SIZE', 10000)
+    if len(HOT_USERS.counters) > 2 * size:
+        HOT_USERS.trim(size)
+    path = app.config.get('HOT_USERS_FILE')
+    if path and time.time() - HOT_USERS.saved > \
+            app.config.get('HOT_USERS_SAVE_INTERVAL', 300):
+        try:
+            HOT_USERS.save(path)
+        except (IOError, OSError):
+            log.warning('Cannot save hot users to %s', path, exc_info=True)
+    return response
+
+
+def generations():
+    """
+    Returns generation tokens of data and users of current dataset.
+    """
+    return utils.data_generation(), utils.users_generation()
+
+
+def prewarm(application, dataset, count):
+    """
+    Recomputes data and results of `count` hottest users of a dataset.
+
+    Requests are made through the test client and marked as prewarming,
+    so they recompute results instead of getting those of the previous
+    generation. Counters of endpoints which no longer exist are skipped.
+    Returns list of requested paths.
+    """
+    environ = {
+        utils.DATASET_ENVIRON_KEY: dataset,
+        utils.PREWARM_ENVIRON_KEY: True,
+    }
+    with application.test_request_context(environ_overrides=environ):
+        if application.config.get('LAZY_LOADING'):
+            utils.get_offset_index()
+        else:
+            utils.get_data()
+        utils.get_users_from_xml()
+        paths = []
+        for hot_dataset, endpoint, user_id in HOT_USERS.top(count):
+            if hot_dataset != dataset:
+                continue
+            try:
+                paths.append(url_for(endpoint, user_id=user_id))
+            except BuildError:
+                log.warning('Cannot prewarm unknown endpoint %s', endpoint)
+    client = application.test_client()
+    for path in paths:
+        response = client.get(
+            path, environ_overrides={utils.PREWARM_ENVIRON_KEY: True}
+        )
+        if response.status_code != 200:
+            log.warning('Prewarming %s failed: %s', path, response.status)
+    return paths
+
+
+def run_prewarm(application, dataset, tokens):
+    """
+    Prewarms a dataset and saves hot users, runs in a background thread.
+    """
+    start = time.time()
+    try:
+        paths = prewarm(
+            application, dataset, application.config.get('PREWARM_USERS', 20)
+        )
+        log.info(
+            'Prewarmed %d results of dataset %s in %.1f ms',
+            len(paths), dataset, (time.time() - start) * 1000
+        )
+        if application.config.get('HOT_USERS_FILE'):
+            HOT_USERS.save(application.config['HOT_USERS_FILE'])
+    except Exception:  # pylint: disable=broad-except
+        log.exception('Prewarming dataset %s failed', dataset)
+    finally:
+        with PREWARM_LOCK:
+            PREWARMED[dataset] = tokens
+            del PREWARMS[dataset]
+
+
+def start_prewarm(dataset):
+    """
+    Starts prewarming of a dataset whose data generation has changed.
+
+    Returns True while results of the new generation are being prepared,
+    False if prewarming is disabled by PREWARM setting or it has already
+    finished for the current generation.
+    """
+    if not app.config.get('PREWARM'):
+        return False
+    tokens = generations()
+    with PREWARM_LOCK:
+        if dataset in PREWARMS:
+            return True
+        if PREWARMED.get(dataset) == tokens:
+            return False
+        thread = threading.Thread(
+            target=run_prewarm,
+            args=(app, dataset, tokens),
+            name='prewarm-{}'.format(dataset)
+        )
+        thread.daemon = True
+        PREWARMS[dataset] = thread
+        thread.start()
+    return True
+
+
+utils.REFRESHERS.append(start_prewarm)
+
+
+def wait_for_prewarm(dataset):
+    """
+    Blocks until results of the current generation of a dataset are
+    prewarmed, returns at once when PREWARM setting is off.
+
+    A prewarming of an older generation may still be running, so it is
+    waited for and a new one started until generations match.
+    """
+    while start_prewarm(dataset):
+        with PREWARM_LOCK:
+            thread = PREWARMS.get(dataset)
+        if thread is not None:
+            thread.join()
+
+
+def prewarm_hot_users(application):
+    """
+    Loads persisted hot users and prewarms their results, used by warm-up.
+    """
+    if application.config.get('HOT_USERS_FILE'):
+        HOT_USERS.load(application.config['HOT_USERS_FILE'])
+        HOT_USERS.trim(application.config.get('HOT_USERS_SIZE', 10000))
+    with application.test_request_context():
+        tokens = generations()
+    paths = prewarm(
+        application, None, application.config.get('PREWARM_USERS', 20)
+    )
+    with PREWARM_LOCK:
+        PREWARMED[None] = tokens
+    return paths
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Static materialization of API responses.
+
+Every `/api/v1/*` response is written to a file laid out like its URL,
+together with a gzipped copy, so a front web server can serve the API from
+disk and use the application only as a fallback, e.g. for nginx:
+
+    location /api/v1/ {
+        root /path/to/var/api;
+        default_type application/json;
+        gzip_static on;
+        try_files $uri @presence_analyzer;
+    }
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+from cStringIO import StringIO
+
+from flask import url_for
+
+from presence_analyzer import utils
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MANIFEST = '.manifest.json'
+API_PREFIX = '/api/v1/'
+DYNAMIC_ENDPOINTS = {
+    'avatar_view', 'cache_stats_view', 'events_view', 'memory_view'
+}
+
+
+def api_endpoints(app, query_views=False):
+    """
+    Returns sorted (endpoint, per_user) pairs of materializable API rules.
+
+    Rules with arguments other than `user_id` cannot be enumerated and are
+    left to the application. So are views reading query arguments, a file
+    would be served whatever the arguments, unless `query_views` is set.
+    """
+    result = set()
+    for rule in app.url_map.iter_rules():
+        if not rule.rule.startswith(API_PREFIX) or \
+                rule.endpoint in DYNAMIC_ENDPOINTS or \
+                not rule.arguments <= {'user_id'}:
+            continue
+        if not query_views and getattr(
+                app.view_functions[rule.endpoint], 'query_args', ()):
+            continue
+        result.add((rule.endpoint, 'user_id' in rule.arguments))
+    return sorted(result)
+
+
+def api_rules(app):
+    """
+    Returns sorted [endpoint, rule] pairs of materializable API rules,
+    kept in the manifest to find responses of removed endpoints.
+    """
+    return sorted(
+        [endpoint, rule.rule]
+        for endpoint, _ in api_endpoints(app)
+        for rule in app.url_map.iter_rules(endpoint)
+        if 'dataset' not in rule.arguments
+    )
+
+
+def rule_paths(rule, user_ids):
+    """
+    Returns paths of a rule for given users, or the rule itself when it
+    does not depend on a user.
+    """
+    if '<int:user_id>' not in rule:
+        return [rule]
+    return [
+        rule.replace('<int:user_id>', unicode(user_id))
+        for user_id in user_ids
+    ]
+
+
+def user_fingerprint(items):
+    """
+    Returns hash of presence entries of a single user.
+    """
+    return hashlib.sha1(repr(sorted(
+        (date, times['start'], times['end'])
+        for date, times in items.iteritems()
+    ))).hexdigest()
+
+
+def write_response(output_dir, path, content):
+    """
+    Writes response and its gzipped copy under output directory.
+    """
+    target = os.path.join(output_dir, path.lstrip('/'))
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    compressed = StringIO()
+    with gzip.GzipFile(
+            filename='', mode='wb', fileobj=compressed, mtime=0) as gz_file:
+        gz_file.write(content)
+    utils.atomic_write(target, content)
+    utils.atomic_write(target + '.gz', compressed.getvalue())
+
+
+def remove_response(output_dir, path):
+    """
+    Removes response and its gzipped copy if they exist.
+    """
+    target = os.path.join(output_dir, path.lstrip('/'))
+    for name in (target, target + '.gz'):
+        if os.path.exists(name):
+            os.unlink(name)
+
+
+def materialize(app, output_dir):
+    """
+    Renders API responses to output directory.
+
+    Responses not depending on a single user are rebuilt when presence data
+    or users XML changed, per-user responses only for users whose entries
+    changed. Everything is rebuilt when API endpoints changed, responses
+    of removed ones are removed. Returns numbers of written and removed
+    responses.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, ValueError):
+        manifest = {'global': None, 'users': {}}
+
+    rules = api_rules(app)
+    rebuild = manifest.get('endpoints') != rules
+    removed = [
+        path
+        for endpoint_rule in manifest.get('endpoints', [])
+        if endpoint_rule not in rules
+        for path in rule_paths(endpoint_rule[1], manifest['users'])
+    ]
+
+    data = utils.get_data()
+    fingerprints = {
+        unicode(user_id): user_fingerprint(items)
+        for user_id, items in data.iteritems()
+    }
+    global_fingerprint = hashlib.sha1(repr((
+        utils.data_generation(), utils.users_generation()
+    ))).hexdigest()
+
+    endpoints = api_endpoints(app)
+    written = []
+    with app.test_request_context():
+        changed = rebuild or manifest['global'] != global_fingerprint
+        if changed:
+            written.extend(
+                url_for(endpoint)
+                for endpoint, per_user in endpoints if not per_user
+            )
+        for user_id, fingerprint in fingerprints.iteritems():
+            user_changed = rebuild or \
+                manifest['users'].get(user_id) != fingerprint
+            if user_changed:
+                written.extend(
+                    url_for(endpoint, user_id=int(user_id))
+                    for endpoint, per_user in endpoints if per_user
+                )
+        for user_id in set(manifest['users']) - set(fingerprints):
+            removed.extend(
+                url_for(endpoint, user_id=int(user_id))
+                for endpoint, per_user in endpoints if per_user
+            )
+
+    client = app.test_client()
+    for path in list(written):
+        response = client.get(path)
+        if response.status_code != 200:
+            log.warning('Skipping %s: %s', path, response.status)
+            written.remove(path)
+            continue
+        write_response(output_dir, path, response.data)
+    for path in removed:
+        remove_response(output_dir, path)
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    utils.atomic_write(manifest_path, json.dumps({
+        'global': global_fingerprint,
+        'users': fingerprints,
+        'endpoints': rules,
+    }))
+    log.info('Materialized %d and removed %d responses in %s',
+             len(written), len(removed), output_dir)
+    return len(written), len(removed)
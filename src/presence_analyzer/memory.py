@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Memory accounting of loaded data, indexes and cache entries.
+"""
+
+import json
+import logging
+import sys
+from collections import OrderedDict
+
+import numpy
+
+from presence_analyzer import utils
+
+try:
+    import tracemalloc  # pylint: disable=import-error
+except ImportError:
+    tracemalloc = None  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SNAPSHOTS_SUFFIX = '.memory'
+MAX_SNAPSHOTS = 10
+TOP_USERS = 10
+
+
+def deep_size(obj, seen):
+    """
+    Returns bytes taken by object and everything it references.
+
+    Objects whose ids are in `seen` are skipped, so structures sharing
+    objects are not counted twice.
+    """
+    size = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.iterkeys())
+            stack.extend(current.itervalues())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        elif isinstance(current, numpy.ndarray):
+            if current.base is not None:
+                stack.append(current.base)
+        elif hasattr(current, '__dict__'):
+            stack.append(vars(current))
+    return size
+
+
+def qualified_name(kind, name, dataset=None):
+    """
+    Returns report name of a structure, suffixed by its named dataset.
+    """
+    if dataset is None:
+        return '{}.{}'.format(kind, name)
+    return '{}.{}@{}'.format(kind, name, dataset)
+
+
+def load_snapshots(path):
+    """
+    Returns totals of previous reports of data file, oldest first.
+
+    Reports are kept in a file next to the data file, so growth is
+    reported across processes, such as runs of the memreport action.
+    """
+    try:
+        with open(path + SNAPSHOTS_SUFFIX, 'r') as snapshots_file:
+            return OrderedDict(
+                (tuple(snapshot['generation']), snapshot)
+                for snapshot in json.load(snapshots_file)
+            )
+    except (IOError, ValueError, KeyError, TypeError):
+        log.debug('No valid memory snapshots of %s', path)
+        return OrderedDict()
+
+
+def save_snapshots(path, snapshots):
+    """
+    Persists totals of reports of data file.
+    """
+    try:
+        utils.atomic_write(
+            path + SNAPSHOTS_SUFFIX, json.dumps(snapshots.values())
+        )
+    except (IOError, OSError):
+        log.warning(
+            'Cannot persist memory snapshots of %s', path, exc_info=True
+        )
+
+
+def memory_report():
+    """
+    Breaks down bytes taken by presence data, INDEXES and CACHE entries.
+
+    Growth is reported against the last report of a different data
+    generation, so a leak shows up as growth between reloads.
+    """
+    data = utils.get_data()
+    seen = set()
+    structures = OrderedDict()
+    structures['data.time_objects'] = sum(
+        deep_size(times[name], seen)
+        for items in data.itervalues()
+        for times in items.itervalues()
+        for name in ('start', 'end')
+    )
+    users = sorted(
+        (
+            (deep_size(items, seen), user_id)
+            for user_id, items in data.iteritems()
+        ),
+        reverse=True
+    )
+    structures['data.user_maps'] = sum(size for size, _ in users) + \
+        deep_size(data, seen)
+    for dataset, indexes in sorted(utils.INDEXES.iteritems()):
+        for name, index in sorted(indexes.iteritems()):
+            structures[qualified_name('indexes', name, dataset)] = \
+                deep_size(index, seen)
+    structures['lazy_users'] = deep_size(utils.LAZY_USERS, seen)
+    for key, entry in sorted(utils.CACHE.iteritems()):
+        name = qualified_name(
+            'cache', entry.get('name', key), entry.get('dataset')
+        )
+        structures[name] = structures.get(name, 0) + deep_size(entry, seen)
+
+    path = utils.dataset_setting('DATA_CSV')
+    generation = utils.data_generation()
+    total = sum(structures.itervalues())
+    snapshots = load_snapshots(path)
+    previous = [
+        snapshot for snapshot_generation, snapshot in snapshots.iteritems()
+        if snapshot_generation != generation[1:]
+    ]
+    growth = OrderedDict()
+    if previous:
+        growth['total'] = total - previous[-1]['total']
+        for name, size in structures.iteritems():
+            growth[name] = size - previous[-1]['structures'].get(name, 0)
+
+    snapshots.pop(generation[1:], None)
+    snapshots[generation[1:]] = {
+        'generation': generation[1:],
+        'total': total,
+        'structures': structures,
+    }
+    while len(snapshots) > MAX_SNAPSHOTS:
+        snapshots.popitem(last=False)
+    save_snapshots(path, snapshots)
+
+    traced = None
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        traced = {'current': current, 'peak': peak}
+    return OrderedDict([
+        ('generation', generation),
+        ('total', total),
+        ('structures', structures),
+        ('largest_users', [
+            {'user_id': user_id, 'bytes': size}
+            for size, user_id in users[:TOP_USERS]
+        ]),
+        ('growth', growth),
+        ('traced', traced),
+    ])
+
+
+def format_report(report):
+    """
+    Formats memory report as a text table.
+    """
+    lines = ['{:<40} {:>12} {:>12}'.format('Structure', 'Bytes', 'Growth')]
+    growth = report['growth']
+    rows = report['structures'].items() + [('total', report['total'])]
+    for name, size in rows:
+        lines.append('{:<40} {:>12} {:>12}'.format(
+            name, size, growth.get(name, '-')
+        ))
+    for user in report['largest_users']:
+        lines.append('{:<40} {:>12}'.format(
+            'user {}'.format(user['user_id']), user['bytes']
+        ))
+    if report['traced']:
+        lines.append('{:<40} {:>12}'.format(
+            'traced (peak {})'.format(report['traced']['peak']),
+            report['traced']['current']
+        ))
+    return '\n'.join(lines)
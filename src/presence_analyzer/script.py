@@ -4,7 +4,6 @@
 
 import os
 import sys
-import urllib
 from functools import partial
 
 import paste.script.command
@@ -28,10 +27,13 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warm_up=True):
+    from presence_analyzer import IMPORT_TIMES, app
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if warm_up and app.config.get('WARM_UP', True):
+        from presence_analyzer.warmup import warm_up as warm_up_app
+        warm_up_app(app, IMPORT_TIMES)
     return app
 
 
@@ -115,12 +117,104 @@ def run():
     # bin/fkask-ctl update_users
     def action_update_users():
         """
-        Update users.xml
+        Update users.xml if it was changed on the server.
         """
-        app = make_app()
-        urllib.urlretrieve(
-                app.config['USERS_XML_LINK'], app.config['USERS_XML']
+        from presence_analyzer.utils import update_users_xml
+        app = make_app(warm_up=False)
+        if update_users_xml(
+                app.config['USERS_XML_LINK'], app.config['USERS_XML']):
+            print "users.xml updated."
+        else:
+            print "users.xml is up to date."
+
+    # bin/flask-ctl materialize
+    def action_materialize(output=('o', '')):
+        """
+        Render API responses to static JSON files.
+
+        Only responses of users whose data changed are rebuilt.
+
+        Options:
+         - '--output' directory, defaults to MATERIALIZE_DIR or var/api
+        """
+        from presence_analyzer.materialize import materialize
+        app = make_app(warm_up=False)
+        output = output or app.config.get(
+            'MATERIALIZE_DIR', abspath('var', 'api')
+        )
+        written, removed = materialize(app, output)
+        print "{} responses written, {} removed in {}.".format(
+            written, removed, output
+        )
+
+    # bin/flask-ctl analyze
+    def action_analyze(output=('o', ''), workers=('w', 0), chunk_size=10):
+        """
+        Compute overtime, late arrivals and missing days of all users.
+
+        Options:
+         - '--output' report file, defaults to var/analyze.json
+         - '--workers' number of processes, defaults to number of CPUs
+         - '--chunk-size' number of users sent to a worker at once
+        """
+        from presence_analyzer.analyze import analyze, write_report
+        from presence_analyzer.utils import get_data
+        app = make_app(warm_up=False)
+        output = output or abspath('var', 'analyze.json')
+
+        def progress(done, total):
+            sys.stderr.write('\r{}/{} users'.format(done, total))
+
+        results = analyze(get_data(), workers, chunk_size, progress)
+        write_report(output, results)
+        print "\nReport of {} users written to {}.".format(
+            len(results), output
+        )
+
+    # bin/flask-ctl memreport
+    def action_memreport():
+        """
+        Print memory taken by loaded data, indexes and cache entries.
+
+        Growth is shown against the last run on another version of the
+        data file.
+        """
+        from presence_analyzer.memory import format_report, memory_report
+        make_app()
+        print format_report(memory_report())
+
+    # bin/flask-ctl verify
+    def action_verify(users=20, days=60, seed=0, min_speedup=1.0):
+        """
+        Check fast paths against reference helpers on a random dataset.
+
+        Every API view must return identical JSON in all loading modes and
+        every fast path must be at least '--min-speedup' times faster.
+
+        Options:
+         - '--users' and '--days' size of generated dataset
+         - '--seed' of the random generator
+         - '--min-speedup' required ratio of reference and fast path times
+        """
+        import shutil
+        import tempfile
+        from presence_analyzer.harness import verify
+        app = make_app(warm_up=False)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            report = verify(app, tmp_dir, users, days, seed, min_speedup)
+        finally:
+            shutil.rmtree(tmp_dir)
+        for name, reference, fast in report['timings']:
+            print "{:<20} {:>9.2f} ms {:>9.2f} ms {:>6.1f}x".format(
+                name, reference * 1000, fast * 1000,
+                reference / fast if fast else float('inf')
             )
-        print "users.xml updated."
+        for mode, path in report['mismatches']:
+            print "Mismatch in {} mode: {}".format(mode, path)
+        for name in report['slow']:
+            print "Fast path too slow: {}".format(name)
+        if report['mismatches'] or report['slow']:
+            sys.exit(1)
 
     werkzeug.script.run()
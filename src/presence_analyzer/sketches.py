@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches.
+"""
+
+
+class QuantileSketch(object):
+    """
+    KLL style quantile sketch.
+
+    Keeps a stack of compactors, an item stored at height `h` represents
+    2**h original values. When the sketch is full the lowest overflowing
+    compactor is sorted and every second item is promoted one level up.
+    Sketches are exact until more than `k` values were added and can be
+    merged without access to the original values.
+    """
+
+    def __init__(self, k=128):
+        self.k = k
+        self.count = 0
+        self.compactors = [[]]
+        self.size = 0
+        self.max_size = self.capacity(0)
+        self._offset = 0
+
+    def __len__(self):
+        return self.count
+
+    def capacity(self, height):
+        """
+        Returns number of items compactor at given height can hold.
+        """
+        depth = len(self.compactors) - height - 1
+        return int(self.k * (2.0 / 3) ** depth) + 2
+
+    def update(self, value):
+        """
+        Adds a single value to the sketch.
+        """
+        self.compactors[0].append(value)
+        self.count += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def merge(self, other):
+        """
+        Adds all values summarized by other sketch to this one.
+        """
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for height, items in enumerate(other.compactors):
+            self.compactors[height].extend(items)
+        self.count += other.count
+        self.size = sum(len(items) for items in self.compactors)
+        self.max_size = sum(
+            self.capacity(height) for height in xrange(len(self.compactors))
+        )
+        while self.size >= self.max_size:
+            self.compress()
+        return self
+
+    def compress(self):
+        """
+        Compacts the lowest overflowing compactor.
+        """
+        for height, items in enumerate(self.compactors):
+            if len(items) < self.capacity(height):
+                continue
+            if height + 1 == len(self.compactors):
+                self.compactors.append([])
+                self.max_size = sum(
+                    self.capacity(level)
+                    for level in xrange(len(self.compactors))
+                )
+            stored = len(items)
+            items.sort()
+            kept = [items.pop()] if stored % 2 else []
+            promoted = items[self._offset::2]
+            self._offset ^= 1
+            self.compactors[height + 1].extend(promoted)
+            self.compactors[height] = kept
+            self.size += len(promoted) + len(kept) - stored
+            if self.size < self.max_size:
+                break
+
+    def quantile(self, fraction):
+        """
+        Returns value at given rank fraction. Returns zero for empty sketch.
+        """
+        if not self.count:
+            return 0
+        weighted = sorted(
+            (value, 2 ** height)
+            for height, items in enumerate(self.compactors)
+            for value in items
+        )
+        total = sum(weight for _, weight in weighted)
+        rank = fraction * total
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= rank:
+                return value
+        return weighted[-1][0]
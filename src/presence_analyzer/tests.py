@@ -4,15 +4,41 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
+import bz2
 import datetime
+import gzip
 import hashlib
 import json
 import time
 import os.path
+import random
+import shutil
+import tempfile
+import threading
 import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import closing
+from cStringIO import StringIO
+from SocketServer import StreamRequestHandler, ThreadingTCPServer
 from datetime import timedelta
 
-from presence_analyzer import main, utils
+import presence_analyzer
+from presence_analyzer import (
+    admission,
+    analyze,
+    avatars,
+    cache_backends,
+    datasets,
+    events,
+    harness,
+    hot,
+    main,
+    materialize,
+    memory,
+    sketches,
+    utils,
+    warmup
+)
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
@@ -22,6 +48,92 @@ TEST_DATA_XML = os.path.join(
 )
 
 
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves `server.content` with an ETag, honours If-None-Match.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Handles GET request.
+        """
+        server = self.server
+        server.requests.append(dict(self.headers))
+        etag = '"{}"'.format(hashlib.sha1(server.content).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(server.content)))
+        self.end_headers()
+        self.wfile.write(server.content)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Keeps test output quiet.
+        """
+        pass
+
+
+def start_stand_in(content):
+    """
+    Starts local HTTP stand-in serving given content in a thread.
+    """
+    server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.content = content
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:{}/users.xml'.format(server.server_port)
+    return server
+
+
+class MemcachedStandInHandler(StreamRequestHandler):
+    """
+    Serves get and set commands of memcached text protocol from a dict.
+    """
+
+    def handle(self):
+        """
+        Handles commands of a single connection.
+        """
+        store = self.server.store
+        for line in iter(self.rfile.readline, b''):
+            parts = line.split()
+            if parts[0] == b'get':
+                if parts[1] in store:
+                    value = store[parts[1]]
+                    self.wfile.write(b'VALUE ' + parts[1] + b' 0 ' +
+                                     str(len(value)).encode() + b'\r\n' +
+                                     value + b'\r\n')
+                self.wfile.write(b'END\r\n')
+            elif parts[0] == b'set':
+                value = self.rfile.read(int(parts[4]) + 2)[:-2]
+                store[parts[1]] = value
+                self.wfile.write(b'STORED\r\n')
+            else:
+                self.wfile.write(b'ERROR\r\n')
+
+
+def start_memcached_stand_in():
+    """
+    Starts local memcached stand-in in a thread.
+    """
+    server = ThreadingTCPServer(('127.0.0.1', 0), MemcachedStandInHandler)
+    server.daemon_threads = True
+    server.store = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'memcached://127.0.0.1:{}'.format(
+        server.server_address[1]
+    )
+    return server
+
+
 # pylint: disable=maybe-no-member, too-many-public-methods
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
     """
@@ -67,6 +179,8 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(
             resp.headers['Content-Type'], 'text/html; charset=utf-8'
         )
+        resp = self.client.get('/presence_trend.html')
+        self.assertEqual(resp.status_code, 200)
         resp = self.client.get('/fake.html')
         self.assertEqual(resp.status_code, 404)
 
@@ -82,12 +196,12 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         user_11 = {
             'user_id': 11,
             'name': 'Maciej D.',
-            'avatar': 'https://intranet.stxnext.pl/api/images/users/11'
+            'avatar': '/api/v1/avatars/11'
         }
         user_10 = {
             'user_id': 10,
             'name': 'Maciej Z.',
-            'avatar': 'https://intranet.stxnext.pl/api/images/users/10'
+            'avatar': '/api/v1/avatars/10'
         }
         self.assertDictEqual(data[0], user_11)
         self.assertDictEqual(data[1], user_10)
@@ -202,6 +316,266 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertListEqual(data[1], ['Worked hours', 26.3])
         self.assertEqual(data[2][1], 141.29)
 
+    def test_company_mean_time_weekday_view(self):
+        """
+        Test company_mean_time_weekday_view.
+        """
+        resp = self.client.get('/api/v1/company/mean_time_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertListEqual(data[0], ['Mon', 24123.0])
+        self.assertListEqual(data[1], ['Tue', 23305.5])
+        self.assertListEqual(data[6], ['Sun', 0])
+
+    def test_company_start_end_distribution_view(self):
+        """
+        Test company_start_end_distribution_view.
+        """
+        resp = self.client.get('/api/v1/company/start_end_distribution')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 97)
+        self.assertListEqual(data[0], ['Time', 'Arrivals', 'Departures'])
+        self.assertListEqual(data[38], ['09:15', 3, 0])
+        self.assertEqual(sum(row[1] for row in data[1:]), 9)
+        self.assertEqual(sum(row[2] for row in data[1:]), 9)
+
+    def test_presence_start_end_percentiles_view(self):
+        """
+        Test presence_start_end_percentiles_view.
+        """
+        resp = self.client.get('/api/v1/presence_start_end_percentiles/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 8)
+        self.assertListEqual(
+            data[0],
+            ['Weekday', 'Median start', 'Median end', 'P90 start', 'P90 end']
+        )
+        self.assertListEqual(data[1], ['Mon', 0, 0, 0, 0])
+        self.assertListEqual(data[2], ['Tue', 34745, 64792, 34745, 64792])
+
+        resp = self.client.get('/api/v1/presence_start_end_percentiles/9')
+        self.assertDictEqual(json.loads(resp.data), {
+            'status': 404,
+            'message': 'User 9 not found!'
+        })
+
+    def test_company_start_end_percentiles_view(self):
+        """
+        Test company_start_end_percentiles_view.
+        """
+        resp = self.client.get('/api/v1/company/start_end_percentiles')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 8)
+        self.assertListEqual(data[2], ['Tue', 33590, 50154, 34745, 64792])
+        self.assertListEqual(data[7], ['Sun', 0, 0, 0, 0])
+
+    def test_occupancy_view(self):
+        """
+        Test occupancy_view.
+        """
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 97)
+        self.assertListEqual(
+            data[0], ['Time', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+        )
+        self.assertListEqual(data[41], ['10:00', 1, 2, 2, 0.5, 0, 0, 0])
+        self.assertListEqual(data[56], ['13:45', 1, 2, 2, 1.5, 1, 0, 0])
+        self.assertListEqual(data[57], ['14:00', 1, 1, 2, 1.5, 1, 0, 0])
+
+        resp = self.client.get('/occupancy.html')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_occupancy_at_view(self):
+        """
+        Test occupancy_at_view.
+        """
+        resp = self.client.get('/api/v1/occupancy/2013-09-10T10:00')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertListEqual(json.loads(resp.data), [
+            {'user_id': 10, 'name': 'Maciej Z.'},
+            {'user_id': 11, 'name': 'Maciej D.'},
+        ])
+
+        resp = self.client.get('/api/v1/occupancy/2013-09-10T14:00')
+        self.assertListEqual(
+            [user['user_id'] for user in json.loads(resp.data)], [10]
+        )
+        resp = self.client.get('/api/v1/occupancy/2013-09-14T10:00')
+        self.assertListEqual(json.loads(resp.data), [])
+
+        resp = self.client.get('/api/v1/occupancy/yesterday')
+        self.assertDictEqual(json.loads(resp.data), {
+            'status': 400,
+            'message': 'Invalid moment yesterday!'
+        })
+
+    def test_trend_view(self):
+        """
+        Test trend_view.
+        """
+        resp = self.client.get('/api/v1/trend/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertListEqual(json.loads(resp.data), [
+            ['Period', 'Presence (h)'],
+            ['2013-09-09', 21.73],
+        ])
+
+        resp = self.client.get(
+            '/api/v1/trend/10?granularity=day&start=2013-09-11'
+        )
+        self.assertListEqual(json.loads(resp.data), [
+            ['Period', 'Presence (h)'],
+            ['2013-09-11', 6.8],
+            ['2013-09-12', 6.58],
+        ])
+
+        resp = self.client.get('/api/v1/trend/11?granularity=month')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[1][0], '2013-09-01')
+
+        for query in ('granularity=month&start=2013-09-20',
+                      'granularity=week&start=2013-09-12&end=2013-09-10'):
+            resp = self.client.get('/api/v1/trend/10?' + query)
+            self.assertListEqual(
+                json.loads(resp.data), [['Period', 'Presence (h)']]
+            )
+
+        resp = self.client.get('/api/v1/trend/11?granularity=year')
+        self.assertDictEqual(json.loads(resp.data), {
+            'status': 400,
+            'message': 'Invalid trend arguments!'
+        })
+        resp = self.client.get('/api/v1/trend/9')
+        self.assertDictEqual(json.loads(resp.data), {
+            'status': 404,
+            'message': 'User 9 not found!'
+        })
+
+    def test_data_quality_view(self):
+        """
+        Test data_quality_view.
+        """
+        resp = self.client.get('/api/v1/data_quality')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertDictEqual(json.loads(resp.data), {
+            'rows': 9,
+            'skipped': 0,
+            'rejected': 0,
+            'duplicates': 0,
+        })
+
+    def test_cache_stats_view(self):
+        """
+        Test cache_stats_view.
+        """
+        utils.get_data()
+        resp = self.client.get('/api/v1/cache_stats')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(
+            data['memory'].keys(),
+            ['hits', 'misses', 'stale', 'sets', 'errors']
+        )
+
+    def test_similar_users_view(self):
+        """
+        Test similar_users_view.
+        """
+        resp = self.client.get('/api/v1/similar/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['user_id'], 11)
+        self.assertEqual(data[0]['name'], 'Maciej D.')
+        self.assertTrue(0 < data[0]['similarity'] < 1)
+
+        resp = self.client.get('/api/v1/similar/10?k=0')
+        self.assertListEqual(json.loads(resp.data), [])
+        resp = self.client.get('/api/v1/similar/9')
+        self.assertDictEqual(json.loads(resp.data), {
+            'status': 404,
+            'message': 'User 9 not found!'
+        })
+
+    def test_events_view(self):
+        """
+        Test events_view.
+        """
+        notifier = events.NOTIFIER
+        resp = self.client.get('/api/v1/events', buffered=False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        stream = iter(resp.response)
+        self.assertEqual(next(stream), 'retry: 10000\n\n')
+        notifier.publish('data', 7)
+        self.assertEqual(
+            next(stream),
+            'id: {}\nevent: data\ndata: {{"generation": 7}}\n\n'.format(
+                notifier.sequence
+            )
+        )
+        resp.close()
+
+        resp = self.client.get(
+            '/api/v1/events', buffered=False,
+            headers={'Last-Event-ID': str(notifier.sequence - 1)}
+        )
+        stream = iter(resp.response)
+        next(stream)
+        self.assertIn('event: data', next(stream))
+
+        main.app.config.update({'EVENTS_MAX_STREAMS': 1})
+        try:
+            rejected = self.client.get('/api/v1/events')
+            self.assertEqual(rejected.status_code, 200)
+            self.assertEqual(rejected.mimetype, 'text/event-stream')
+            self.assertEqual(rejected.data, 'retry: 10000\n\n')
+            self.assertEqual(notifier.streams, 1)
+            resp.close()
+            self.assertEqual(notifier.streams, 0)
+            resp = self.client.get('/api/v1/events', buffered=False)
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+        finally:
+            main.app.config.pop('EVENTS_MAX_STREAMS')
+
+    def test_memory_view(self):
+        """
+        Test memory_view.
+        """
+        resp = self.client.get('/api/v1/memory')
+        self.assertEqual(resp.status_code, 404)
+
+        main.app.config.update({'MEMORY_REPORT': True})
+        try:
+            resp = self.client.get('/api/v1/memory')
+        finally:
+            main.app.config.update({'MEMORY_REPORT': False})
+            os.remove(TEST_DATA_CSV + memory.SNAPSHOTS_SUFFIX)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertIn('data.user_maps', data['structures'])
+        self.assertIn('data.time_objects', data['structures'])
+        self.assertEqual(len(data['largest_users']), 2)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -263,13 +637,70 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         cached_time = utils.CACHE[key]['time']
         utils.get_data()
         self.assertEqual(cached_time, utils.CACHE[key]['time'])
-        time.sleep(1)
-        utils.get_data()
+        time.sleep(0.01)
+        stat = os.stat(TEST_DATA_CSV)
+        os.utime(TEST_DATA_CSV, (stat.st_atime, stat.st_mtime + 1))
+        try:
+            utils.get_data()
+        finally:
+            os.utime(TEST_DATA_CSV, (stat.st_atime, stat.st_mtime))
         self.assertNotEqual(cached_time, utils.CACHE[key]['time'])
         utils.CACHE[key]['data'] = 'Lorem Ipsum is simply dummy text'
         self.assertNotEqual(utils.CACHE[key]['data'], data)
         utils.CACHE = {}
 
+        calls = []
+
+        @utils.cache(50)
+        def counted():  # pylint: disable=missing-docstring
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(counted(), 1)
+        self.assertEqual(counted(), 1)
+        time.sleep(0.1)
+        self.assertEqual(counted(), 2)
+        utils.CACHE = {}
+
+        @utils.cache(1000)
+        def power(base, exponent=2):  # pylint: disable=missing-docstring
+            calls.append(1)
+            return base ** exponent
+
+        self.assertEqual(power(3), 9)
+        self.assertEqual(power(2), 4)
+        self.assertEqual(power(2, exponent=3), 8)
+        self.assertEqual(power(3), 9)
+        self.assertEqual(len(calls), 5)
+        utils.CACHE = {}
+
+    def test_warm_up(self):
+        """
+        Test warming up data, indexes and templates before serving.
+        """
+        utils.CACHE = {}
+        timings = warmup.warm_up(main.app, [('import numpy', 0.5)])
+        stages = [name for name, _ in timings]
+        self.assertEqual(stages[0], 'import numpy')
+        self.assertIn('data', stages)
+        self.assertIn('templates', stages)
+        self.assertTrue(all(seconds >= 0 for _, seconds in timings))
+        self.assertIn(
+            hashlib.sha1(utils.get_data.__name__).hexdigest(), utils.CACHE
+        )
+        self.assertIn(
+            'occupancy.html', warmup.compile_templates(main.app)
+        )
+        self.assertListEqual(
+            [name for name, _ in presence_analyzer.IMPORT_TIMES], [
+                'import numpy',
+                'import lxml.etree',
+                'import flask',
+                'import flask_mako',
+                'import presence_analyzer',
+            ]
+        )
+
     def test_get_users_from_xml(self):
         """
         Test extracting user informations from xml.
@@ -286,6 +717,69 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             }
         })
 
+    def test_update_users_xml(self):
+        """
+        Test conditional, atomic refresh of users XML.
+        """
+        with open(TEST_DATA_XML, 'rb') as xml_file:
+            content = xml_file.read()
+        server = start_stand_in(content)
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'users.xml')
+        try:
+            self.assertEqual(utils.get_generation(path), 0)
+            self.assertTrue(utils.update_users_xml(server.url, path))
+            with open(path, 'rb') as xml_file:
+                self.assertEqual(xml_file.read(), content)
+            self.assertEqual(utils.get_generation(path), 1)
+            for name in (path, path + utils.META_SUFFIX):
+                self.assertEqual(
+                    os.stat(name).st_mode & 0o777,
+                    0o644 & ~utils.read_umask()
+                )
+
+            self.assertFalse(utils.update_users_xml(server.url, path))
+            self.assertIn('if-none-match', server.requests[-1])
+            self.assertEqual(utils.get_generation(path), 1)
+
+            server.content = b'<intranet><users><user id="1">'
+            with self.assertRaises(ValueError):
+                utils.update_users_xml(server.url, path)
+            with open(path, 'rb') as xml_file:
+                self.assertEqual(xml_file.read(), content)
+            self.assertEqual(utils.get_generation(path), 1)
+            self.assertListEqual(
+                [name for name in os.listdir(tmp_dir)
+                 if name.startswith('.tmp-')],
+                []
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmp_dir)
+
+    def test_get_users_from_xml_generation(self):
+        """
+        Test that bumping users XML generation drops cached users.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'users.xml')
+        shutil.copy(TEST_DATA_XML, path)
+        main.app.config.update({'USERS_XML': path})
+        try:
+            self.assertIn(10, utils.get_users_from_xml())
+            with open(path, 'w') as xml_file:
+                xml_file.write(
+                    '<intranet><server><host>h</host>'
+                    '<protocol>http</protocol></server><users /></intranet>'
+                )
+            self.assertIn(10, utils.get_users_from_xml())
+            utils.bump_generation(path)
+            self.assertDictEqual(utils.get_users_from_xml(), {})
+        finally:
+            main.app.config.update({'USERS_XML': TEST_DATA_XML})
+            shutil.rmtree(tmp_dir)
+
     def test_get_data(self):
         """
         Test parsing of CSV file.
@@ -301,6 +795,176 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             datetime.time(9, 39, 5)
         )
 
+    def test_get_data_compressed(self):
+        """
+        Test reading gzip and bzip2 compressed CSV files.
+        """
+        expected = utils.get_data()
+        with open(TEST_DATA_CSV, 'rb') as csv_file:
+            content = csv_file.read()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for opener in (gzip.open, bz2.BZ2File):
+                path = os.path.join(tmp_dir, 'data.csv.' + opener.__name__)
+                with closing(opener(path, 'wb')) as compressed:
+                    compressed.write(content)
+                main.app.config.update({'DATA_CSV': path})
+                self.assertDictEqual(utils.get_data(), expected)
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            shutil.rmtree(tmp_dir)
+
+    def test_build_offset_index(self):
+        """
+        Test mapping users to merged byte ranges of their lines.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csv_file:
+            csv_file.write(
+                'user_id,date,start,end\n'
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '10,2013-09-11,09:00:00,17:00:00\n'
+                '11,2013-09-10,09:00:00,17:00:00\n'
+                '10,2013-09-12,09:00:00,17:00:00\n'
+            )
+        try:
+            self.assertDictEqual(utils.build_offset_index(path), {
+                10: [[23, 87], [119, 151]],
+                11: [[87, 119]],
+            })
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_lazy_loading(self):
+        """
+        Test per-user views read only lines of the user in lazy mode.
+        """
+        paths = [
+            '/api/v1/{}/{}'.format(view, user_id)
+            for view in (
+                'mean_time_weekday', 'presence_weekday', 'presence_start_end',
+                'presence_start_end_percentiles', 'weekly_mean_presence',
+                'trend'
+            )
+            for user_id in (10, 11, 9)
+        ]
+        client = main.app.test_client()
+        expected = [client.get(url).data for url in paths]
+
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({
+            'DATA_CSV': path,
+            'LAZY_LOADING': True,
+            'LAZY_USERS_SIZE': 2,
+        })
+        utils.LAZY_USERS.clear()
+        utils.CACHE.clear()
+        try:
+            self.assertListEqual(
+                [client.get(url).data for url in paths], expected
+            )
+            self.assertTrue(os.path.exists(path + utils.OFFSETS_SUFFIX))
+            self.assertNotIn(
+                hashlib.sha1('get_data').hexdigest(), utils.CACHE
+            )
+            self.assertListEqual(
+                [key[2] for key in utils.LAZY_USERS], [11, 9]
+            )
+
+            with open(TEST_DATA_CSV, 'rb') as csv_file:
+                content = csv_file.read()
+            with closing(gzip.open(path, 'wb')) as compressed:
+                compressed.write(content)
+            self.assertIsNone(utils.get_offset_index())
+            self.assertEqual(client.get(paths[0]).data, expected[0])
+        finally:
+            main.app.config.update({
+                'DATA_CSV': TEST_DATA_CSV,
+                'LAZY_LOADING': False,
+            })
+            utils.LAZY_USERS.clear()
+            shutil.rmtree(tmp_dir)
+
+    def test_get_data_rejected_rows(self):
+        """
+        Test that malformed rows are counted and dropped.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csv_file:
+            csv_file.write(
+                'user_id,date,start,end\n'
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '12,2013-09-1X,09:00:00,17:00:00\n'
+                '10,2013-09-10,10:00:00,16:00:00\n'
+                '11,2013-09-11,08:00:00\n'
+            )
+        main.app.config.update({'DATA_CSV': path})
+        try:
+            data = utils.get_data()
+            self.assertItemsEqual(data.keys(), [10])
+            self.assertEqual(
+                data[10][datetime.date(2013, 9, 10)]['start'],
+                datetime.time(10, 0, 0)
+            )
+            self.assertDictEqual(utils.get_data_quality(), {
+                'rows': 5,
+                'skipped': 1,
+                'rejected': 2,
+                'duplicates': 1,
+            })
+            tuesday = utils.get_weekday_aggregates()[10][1]
+            self.assertDictEqual(tuesday, {
+                'count': 1,
+                'presence': 21600,
+                'start': 36000,
+                'end': 57600,
+            })
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            shutil.rmtree(tmp_dir)
+
+    def test_parse_date_time(self):
+        """
+        Test fast date and time parsing matches strptime.
+        """
+        for value in ('2013-09-10', '2013-9-10', '2012-02-29', '2013-02-29',
+                      '2013-13-01', '13-09-10', '2013-09-10\n', ''):
+            try:
+                expected = datetime.datetime.strptime(
+                    value, '%Y-%m-%d'
+                ).date()
+            except ValueError:
+                self.assertRaises(ValueError, utils.parse_date, value)
+            else:
+                self.assertEqual(utils.parse_date(value), expected)
+        for value in ('09:00:00', '9:5:7', '00:00:00', '23:59:59',
+                      '24:00:00', '12:60:00', '12:00:60', '12:00', ' 9:00'):
+            try:
+                expected = datetime.datetime.strptime(
+                    value, '%H:%M:%S'
+                ).time()
+            except ValueError:
+                self.assertRaises(ValueError, utils.parse_time, value)
+            else:
+                self.assertEqual(utils.parse_time(value), expected)
+
+    def test_weekday_means(self):
+        """
+        Test calculating means of weekday aggregates.
+        """
+        aggregates = utils.get_weekday_aggregates()[10]
+        self.assertListEqual(
+            utils.weekday_means(aggregates, 'presence'),
+            [
+                utils.mean(intervals)
+                for intervals in utils.group_by_weekday(utils.get_data()[10])
+            ]
+        )
+
     def test_group_by_weekday(self):
         """
         Test gruping items by weekday.
@@ -354,6 +1018,125 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertAlmostEqual(utils.mean([0.3, 0.3, 0.3, 0.5, 0.5, 0.5]), 0.4)
         self.assertEqual(utils.mean([0.5, -1, 0.9, 0.5, -6]), -1.02)
 
+    def test_trend(self):
+        """
+        Test summing trend rollups per period.
+        """
+        rollup = utils.build_trend_rollup({
+            datetime.date(2013, 12, 30): 3600,
+            datetime.date(2014, 1, 2): 7200,
+            datetime.date(2014, 2, 3): 1800,
+        })
+        self.assertListEqual(utils.trend(rollup, 'month'), [
+            (datetime.date(2013, 12, 1), 3600),
+            (datetime.date(2014, 1, 1), 7200),
+            (datetime.date(2014, 2, 1), 1800),
+        ])
+        self.assertListEqual(utils.trend(rollup, 'week'), [
+            (datetime.date(2013, 12, 30), 10800),
+            (datetime.date(2014, 1, 6), 0),
+            (datetime.date(2014, 1, 13), 0),
+            (datetime.date(2014, 1, 20), 0),
+            (datetime.date(2014, 1, 27), 0),
+            (datetime.date(2014, 2, 3), 1800),
+        ])
+        self.assertListEqual(
+            utils.trend(
+                rollup, 'week',
+                datetime.date(2013, 12, 31), datetime.date(2014, 1, 5)
+            ),
+            [(datetime.date(2013, 12, 30), 7200)]
+        )
+        self.assertListEqual(
+            utils.trend(rollup, 'day', datetime.date(2015, 1, 1)), []
+        )
+        for granularity in ('week', 'month'):
+            for start, end in (
+                    (datetime.date(2014, 2, 5), None),
+                    (None, datetime.date(2013, 12, 29)),
+                    (datetime.date(2014, 1, 2), datetime.date(2013, 12, 30))):
+                self.assertListEqual(
+                    utils.trend(rollup, granularity, start, end), []
+                )
+
+    def test_update_trend_rollup(self):
+        """
+        Test rollups are reused, extended by appended days or rebuilt.
+        """
+        days = {
+            datetime.date(2013, 12, 30): 3600,
+            datetime.date(2014, 1, 2): 7200,
+        }
+        rollup = utils.build_trend_rollup(days)
+        self.assertIs(
+            utils.update_trend_rollup(rollup, days, dict(days)), rollup
+        )
+        for changed in (
+                {datetime.date(2014, 1, 5): 1800},
+                {datetime.date(2014, 1, 1): 1800},
+                {datetime.date(2014, 1, 2): 1800}):
+            new_days = dict(days)
+            new_days.update(changed)
+            updated = utils.update_trend_rollup(rollup, days, new_days)
+            expected = utils.build_trend_rollup(new_days)
+            self.assertEqual(updated['first'], expected['first'])
+            self.assertEqual(updated['last'], expected['last'])
+            self.assertListEqual(
+                list(updated['prefix']), list(expected['prefix'])
+            )
+        self.assertListEqual(
+            list(rollup['prefix']), [0, 3600, 3600, 3600, 10800]
+        )
+
+        with open(TEST_DATA_CSV, 'r') as csv_file:
+            content = csv_file.read()
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csv_file:
+            csv_file.write(content)
+        main.app.config.update({'DATA_CSV': path})
+        try:
+            rollups = utils.get_trend_rollups()
+            with open(path, 'a') as csv_file:
+                csv_file.write('\n10,2013-09-20,09:00:00,17:00:00\n')
+            updated = utils.get_trend_rollups()
+            self.assertIs(updated[11], rollups[11])
+            self.assertEqual(updated[10]['last'], datetime.date(2013, 9, 20))
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            utils.TREND_ROLLUPS.clear()
+            shutil.rmtree(tmp_dir)
+
+    def test_similar_users(self):
+        """
+        Test top-k schedule similarity search.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csv_file:
+            csv_file.write(
+                '1,2013-09-09,09:00:00,17:00:00\n'
+                '2,2013-09-16,09:00:00,17:00:00\n'
+                '3,2013-09-09,13:00:00,21:00:00\n'
+                '4,2013-09-10,09:00:00,17:00:00\n'
+            )
+        main.app.config.update({'DATA_CSV': path})
+        try:
+            vectors = utils.get_schedule_vectors()
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(vectors['matrix'].shape, (4, 7 * 96))
+        result = utils.similar_users(vectors, 1, 3)
+        self.assertListEqual([user_id for user_id, _ in result], [2, 3, 4])
+        self.assertAlmostEqual(result[0][1], 1.0)
+        self.assertAlmostEqual(result[1][1], 0.5)
+        self.assertAlmostEqual(result[2][1], 0.0)
+        self.assertListEqual(
+            [user_id for user_id, _ in utils.similar_users(vectors, 1, 1)],
+            [2]
+        )
+
     def test_group_start_end_by_weekday(self):
         """
         Test gruping presence entrences/leaves by weekday.
@@ -380,6 +1163,1024 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertIn(54242, user_data[4]['end'])
 
 
+class MaterializeTestCase(unittest.TestCase):
+    """
+    Static materialization tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_csv = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        main.app.config.update({'DATA_CSV': self.data_csv})
+        main.app.config.update({'USERS_XML': TEST_DATA_XML})
+        self.output = os.path.join(self.tmp_dir, 'api')
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        shutil.rmtree(self.tmp_dir)
+
+    def test_materialize(self):
+        """
+        Test rendering responses to files and incremental rebuild.
+        """
+        written, removed = materialize.materialize(main.app, self.output)
+        per_user = len([
+            endpoint
+            for endpoint, user in materialize.api_endpoints(main.app) if user
+        ])
+        self.assertEqual(removed, 0)
+        self.assertGreater(written, 2 * per_user)
+
+        for path in ('/api/v1/users', '/api/v1/mean_time_weekday/10'):
+            target = os.path.join(self.output, path.lstrip('/'))
+            with open(target, 'rb') as response_file:
+                self.assertEqual(
+                    response_file.read(), self.client.get(path).data
+                )
+            with gzip.open(target + '.gz', 'rb') as response_file:
+                self.assertEqual(
+                    response_file.read(), self.client.get(path).data
+                )
+        self.assertFalse(os.path.exists(
+            os.path.join(self.output, 'api', 'v1', 'cache_stats')
+        ))
+
+        self.assertTupleEqual(
+            materialize.materialize(main.app, self.output), (0, 0)
+        )
+
+        manifest_path = os.path.join(self.output, materialize.MANIFEST)
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest['endpoints'].append(
+            ['gone_view', '/api/v1/gone/<int:user_id>']
+        )
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        materialize.write_response(self.output, '/api/v1/gone/10', '[]')
+        self.assertTupleEqual(
+            materialize.materialize(main.app, self.output),
+            (written, len(manifest['users']))
+        )
+        self.assertFalse(os.path.exists(
+            os.path.join(self.output, 'api', 'v1', 'gone', '10')
+        ))
+
+        with open(self.data_csv, 'a') as csv_file:
+            csv_file.write('\n10,2013-09-16,09:00:00,17:00:00\n')
+        written, removed = materialize.materialize(main.app, self.output)
+        global_endpoints = len(materialize.api_endpoints(main.app)) - per_user
+        self.assertEqual(written, global_endpoints + per_user)
+        for endpoint in ('trend', 'similar'):
+            self.assertFalse(os.path.exists(
+                os.path.join(self.output, 'api', 'v1', endpoint)
+            ))
+
+        with open(self.data_csv, 'w') as csv_file:
+            csv_file.write('11,2013-09-16,09:00:00,17:00:00\n')
+        written, removed = materialize.materialize(main.app, self.output)
+        self.assertEqual(removed, per_user)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.output, 'api', 'v1', 'mean_time_weekday', '10')
+        ))
+
+
+class AdmissionTestCase(unittest.TestCase):
+    """
+    Admission control tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'USERS_XML': TEST_DATA_XML})
+        self.client = main.app.test_client()
+        admission.STALE_RESULTS.clear()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        for name in ('ADMISSION_MAX_ACTIVE', 'ADMISSION_MAX_QUEUED',
+                     'REQUEST_DEADLINE', 'ADMISSION_STALE_SIZE'):
+            main.app.config.pop(name, None)
+        admission.STALE_RESULTS.clear()
+
+    def test_acquire(self):
+        """
+        Test limits of running and queued computations.
+        """
+        controller = admission.AdmissionController()
+        self.assertTrue(controller.acquire(1, 1, 0))
+        self.assertFalse(controller.acquire(1, 0, 1))
+        self.assertFalse(controller.acquire(1, 1, 0.01))
+        timer = threading.Timer(0.05, controller.release)
+        timer.start()
+        self.assertTrue(controller.acquire(1, 1, 5))
+        timer.join()
+        self.assertEqual(controller.active, 1)
+        self.assertEqual(controller.queued, 0)
+
+    def test_overloaded(self):
+        """
+        Test that requests over the limit get 503 or a stale response.
+        """
+        main.app.config.update({
+            'ADMISSION_MAX_ACTIVE': 1,
+            'ADMISSION_MAX_QUEUED': 0,
+        })
+        self.assertTrue(admission.ADMISSION.acquire(1, 0, 0))
+        try:
+            resp = self.client.get('/api/v1/mean_time_weekday/10')
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '5')
+            self.assertEqual(json.loads(resp.data)['status'], 503)
+        finally:
+            admission.ADMISSION.release()
+
+        fresh = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(fresh.status_code, 200)
+        self.assertTrue(admission.ADMISSION.acquire(1, 0, 0))
+        try:
+            resp = self.client.get('/api/v1/mean_time_weekday/10')
+        finally:
+            admission.ADMISSION.release()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, fresh.data)
+        self.assertIn('Stale', resp.headers['Warning'])
+
+    def test_deadline(self):
+        """
+        Test serving stale response when computation misses the deadline.
+        """
+        main.app.config.update({'REQUEST_DEADLINE': 0.05})
+        release = threading.Event()
+        calls = []
+
+        @admission.admission
+        @utils.jsonify
+        def slow():  # pylint: disable=missing-docstring
+            calls.append(1)
+            if len(calls) > 1:
+                release.wait(5)
+            return len(calls)
+
+        with main.app.test_request_context('/slow'):
+            self.assertEqual(slow().data, '1')
+            resp = slow()
+            self.assertEqual(resp.data, '1')
+            self.assertIn('Warning', resp.headers)
+            release.set()
+            for _ in xrange(100):
+                if admission.ADMISSION.active == 0:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(admission.ADMISSION.active, 0)
+            self.assertEqual(
+                admission.STALE_RESULTS[('slow', (), (), (), None)][0], '2'
+            )
+
+    def test_stale_results(self):
+        """
+        Test stale responses are keyed by read query arguments and bounded.
+        """
+        main.app.config.update({'ADMISSION_STALE_SIZE': 2})
+        self.client.get('/api/v1/similar/10?k=1&cache_buster=1')
+        self.client.get('/api/v1/similar/10?cache_buster=2&k=1')
+        self.assertListEqual(admission.STALE_RESULTS.keys(), [
+            ('similar_users_view', (), (('user_id', 10),), (('1',),), None),
+        ])
+        self.client.get('/api/v1/mean_time_weekday/10?cache_buster=3')
+        self.client.get('/api/v1/mean_time_weekday/11')
+        self.assertListEqual(
+            [key[2] for key in admission.STALE_RESULTS],
+            [(('user_id', 10),), (('user_id', 11),)]
+        )
+
+
+class ChangeNotifierTestCase(unittest.TestCase):
+    """
+    Change notifier tests.
+    """
+
+    def test_check(self):
+        """
+        Test publishing events of changed sources only.
+        """
+        generations = {'data': 1, 'users': 1}
+        reloads = []
+        notifier = events.ChangeNotifier({
+            name: (
+                lambda name=name: generations[name],
+                lambda name=name: reloads.append(name)
+            )
+            for name in generations
+        })
+        notifier.generations = dict(generations)
+        notifier.check()
+        self.assertListEqual(notifier.wait(0, 0), [])
+
+        generations['users'] = ('/srv/users.xml', 2)
+        notifier.check()
+        self.assertListEqual(reloads, ['users'])
+        self.assertListEqual(notifier.wait(0, 0), [(1, 'users', 1)])
+        self.assertListEqual(notifier.wait(1, 0), [])
+
+    def test_wait(self):
+        """
+        Test that waiting clients are woken up by a published event.
+        """
+        notifier = events.ChangeNotifier({})
+        timer = threading.Timer(0.05, notifier.publish, ('data', 3))
+        timer.start()
+        self.assertListEqual(notifier.wait(0, 5), [(1, 'data', 3)])
+        timer.join()
+
+
+class MemoryReportTestCase(unittest.TestCase):
+    """
+    Memory accounting tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        main.app.config.update({'DATA_CSV': self.path})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        shutil.rmtree(self.tmp_dir)
+
+    def test_deep_size(self):
+        """
+        Test that shared objects are counted once.
+        """
+        shared = [1000, 2000]
+        seen = set()
+        first = memory.deep_size({'a': shared}, seen)
+        second = memory.deep_size({'b': shared}, seen)
+        self.assertGreater(first, second)
+
+    def test_memory_report(self):
+        """
+        Test breakdown and growth between generations.
+        """
+        report = memory.memory_report()
+        self.assertDictEqual(report['growth'], {})
+        self.assertEqual(
+            report['total'], sum(report['structures'].values())
+        )
+        self.assertGreater(report['structures']['data.time_objects'], 0)
+        self.assertIn('indexes.weekday_aggregates', report['structures'])
+        self.assertIn('cache.get_data', report['structures'])
+        self.assertIn('user 10', memory.format_report(report))
+
+        with open(self.path, 'a') as csv_file:
+            csv_file.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        # snapshots are persisted, as for a report of another process
+        report = memory.memory_report()
+        self.assertGreater(report['growth']['data.user_maps'], 0)
+        self.assertEqual(len(memory.load_snapshots(self.path)), 2)
+
+
+class AnalyzeTestCase(unittest.TestCase):
+    """
+    Batch analytics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+    def test_analyze_user(self):
+        """
+        Test reports of a single user.
+        """
+        report = analyze.analyze_user(utils.get_data()[11])
+        self.assertDictEqual(report, {
+            'days': 6,
+            'overtime_days': 0,
+            'overtime_hours': 0,
+            'late_arrivals': 2,
+            'missing_days': ['2013-09-06'],
+        })
+        report = analyze.analyze_user(utils.get_data()[10])
+        self.assertEqual(report['overtime_days'], 1)
+        self.assertEqual(report['overtime_hours'], 0.35)
+
+    def test_analyze(self):
+        """
+        Test analyzing users in a process pool.
+        """
+        data = utils.get_data()
+        progress = []
+        results = analyze.analyze(
+            data, workers=2, chunk_size=1,
+            progress=lambda done, total: progress.append((done, total))
+        )
+        self.assertItemsEqual(results.keys(), [10, 11])
+        self.assertDictEqual(results[11], analyze.analyze_user(data[11]))
+        self.assertListEqual(progress, [(1, 2), (2, 2)])
+        self.assertDictEqual(analyze.analyze(data, workers=1), results)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'report.json')
+            analyze.write_report(path, results)
+            with open(path, 'r') as report_file:
+                report = json.load(report_file)
+            self.assertEqual(report['users']['10']['days'], 3)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class AvatarsTestCase(unittest.TestCase):
+    """
+    Avatar cache tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        if avatars.Image is not None:
+            image = avatars.Image.new('RGB', (200, 100), (255, 0, 0))
+            content = StringIO()
+            image.save(content, 'JPEG')
+            content = content.getvalue()
+        else:
+            content = b'\x89PNG\r\n\x1a\nnot really an image'
+        self.server = start_stand_in(content)
+        with open(TEST_DATA_XML, 'rb') as xml_file:
+            users_xml = xml_file.read().replace(
+                b'<host>intranet.stxnext.pl</host>',
+                '<host>127.0.0.1:{}</host>'.format(
+                    self.server.server_port
+                ).encode()
+            ).replace(b'>https<', b'>http<')
+        self.users_xml = os.path.join(self.tmp_dir, 'users.xml')
+        with open(self.users_xml, 'wb') as xml_file:
+            xml_file.write(users_xml)
+        self.cache_dir = os.path.join(self.tmp_dir, 'avatars')
+        main.app.config.update({
+            'USERS_XML': self.users_xml,
+            'AVATAR_CACHE_DIR': self.cache_dir,
+        })
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        main.app.config.update({'USERS_XML': TEST_DATA_XML})
+        main.app.config.pop('AVATAR_CACHE_DIR')
+        shutil.rmtree(self.tmp_dir)
+
+    def test_avatar_view(self):
+        """
+        Test avatar is fetched once and served with validators.
+        """
+        resp = self.client.get('/api/v1/avatars/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'image/png')
+        self.assertIn('max-age', resp.headers['Cache-Control'])
+        if avatars.Image is not None:
+            image = avatars.Image.open(StringIO(resp.data))
+            self.assertLessEqual(max(image.size), 64)
+
+        resp = self.client.get('/api/v1/avatars/10')
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(
+            '/api/v1/avatars/10',
+            headers={'If-None-Match': resp.headers['ETag']}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(len(self.server.requests), 1)
+        url = utils.get_users_from_xml()[10]['avatar']
+        self.assertListEqual(
+            os.listdir(self.cache_dir),
+            ['{}.avatar'.format(hashlib.sha1(url).hexdigest())]
+        )
+        self.assertDictEqual(avatars.FETCH_LOCKS, {})
+
+        resp = self.client.get('/api/v1/avatars/12')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_avatar_unavailable(self):
+        """
+        Test redirect to intranet when avatar cannot be fetched.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        resp = self.client.get('/api/v1/avatars/11')
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(
+            resp.headers['Location'].endswith('/api/images/users/11')
+        )
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_enforce_size_cap(self):
+        """
+        Test least recently used avatars are evicted first.
+        """
+        os.makedirs(self.cache_dir)
+        for user_id in xrange(3):
+            path = os.path.join(self.cache_dir, '{}.avatar'.format(user_id))
+            with open(path, 'wb') as avatar_file:
+                avatar_file.write(b'x' * 100)
+            os.utime(path, (1000 + user_id, 1000 + user_id))
+        os.utime(os.path.join(self.cache_dir, '0.avatar'), (2000, 2000))
+        with open(os.path.join(self.cache_dir, '.tmp-1'), 'wb') as tmp_file:
+            tmp_file.write(b'x' * 100)
+        avatars.enforce_size_cap(self.cache_dir, 200)
+        self.assertListEqual(
+            sorted(os.listdir(self.cache_dir)),
+            ['.tmp-1', '0.avatar', '2.avatar']
+        )
+
+
+class DatasetsTestCase(unittest.TestCase):
+    """
+    Named datasets tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        office_csv = os.path.join(self.tmp_dir, 'office.csv')
+        with open(office_csv, 'w') as csv_file:
+            csv_file.write('10,2013-09-16,09:00:00,17:00:00\n')
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'USERS_XML': TEST_DATA_XML,
+            'DATASETS': {
+                name: {'DATA_CSV': path, 'USERS_XML': TEST_DATA_XML}
+                for name, path in (
+                    ('office', office_csv), ('branch', TEST_DATA_CSV)
+                )
+            },
+        })
+        datasets.USAGE.clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('DATASETS')
+        main.app.config.pop('DATASETS_MEMORY_BUDGET', None)
+        for dataset in ('office', 'branch'):
+            utils.evict_dataset(dataset)
+        self.wait_for_measurements()
+        datasets.USAGE.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def wait_for_measurements():
+        """
+        Waits until sizes of datasets are measured.
+        """
+        for thread in datasets.MEASUREMENTS.values():
+            thread.join()
+
+    def test_measure_in_background(self):
+        """
+        Test requests do not wait for dataset size to be measured.
+        """
+        release = threading.Event()
+        dataset_size = datasets.dataset_size
+
+        def blocked_size(dataset):  # pylint: disable=missing-docstring
+            release.wait(5)
+            return dataset_size(dataset)
+
+        datasets.dataset_size = blocked_size
+        try:
+            resp = self.client.get('/api/v1/office/mean_time_weekday/10')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(datasets.USAGE['office']['bytes'], 0)
+            self.assertIn('office', datasets.MEASUREMENTS)
+        finally:
+            release.set()
+            self.wait_for_measurements()
+            datasets.dataset_size = dataset_size
+        self.assertGreater(datasets.USAGE['office']['bytes'], 0)
+        self.assertNotIn('office', datasets.MEASUREMENTS)
+
+    def test_dataset_views(self):
+        """
+        Test views of a named dataset are computed from its own files.
+        """
+        resp = self.client.get('/api/v1/office/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)[0], ['Mon', 28800])
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(json.loads(resp.data)[0], ['Mon', 0])
+        self.assertIn('office', utils.INDEXES)
+
+        resp = self.client.get('/api/v1/office/users')
+        self.assertEqual(
+            json.loads(resp.data)[0]['avatar'], '/api/v1/office/avatars/11'
+        )
+        resp = self.client.get('/api/v1/unknown/users')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/office/cache_stats')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_evict_datasets(self):
+        """
+        Test idle datasets are evicted when over memory budget.
+        """
+        self.client.get('/api/v1/office/mean_time_weekday/10')
+        self.wait_for_measurements()
+        self.assertGreater(datasets.USAGE['office']['bytes'], 0)
+        self.client.get('/api/v1/branch/mean_time_weekday/10')
+        self.wait_for_measurements()
+        self.assertListEqual(datasets.USAGE.keys(), ['office', 'branch'])
+
+        main.app.config.update({
+            'DATASETS_MEMORY_BUDGET': datasets.USAGE['branch']['bytes'],
+        })
+        self.assertListEqual(datasets.evict_datasets(0, 60), [])
+        self.client.get('/api/v1/branch/mean_time_weekday/10')
+        self.assertIn('office', utils.INDEXES)
+
+        self.assertListEqual(
+            datasets.evict_datasets(
+                datasets.USAGE['branch']['bytes'], 0, 'branch'
+            ),
+            ['office']
+        )
+        self.assertNotIn('office', utils.INDEXES)
+        self.assertFalse([
+            entry for entry in utils.CACHE.itervalues()
+            if entry.get('dataset') == 'office'
+        ])
+        self.assertIn('branch', utils.INDEXES)
+
+        resp = self.client.get('/api/v1/office/mean_time_weekday/10')
+        self.assertEqual(json.loads(resp.data)[0], ['Mon', 28800])
+
+    def test_dataset_in_use(self):
+        """
+        Test datasets with requests in flight are not evicted and evicted
+        indexes are loaded again.
+        """
+        self.client.get('/api/v1/office/mean_time_weekday/10')
+        self.wait_for_measurements()
+        self.assertEqual(datasets.USAGE['office']['active'], 0)
+        with main.app.test_request_context(
+                '/api/v1/office/mean_time_weekday/10'):
+            main.app.preprocess_request()
+            self.assertEqual(datasets.USAGE['office']['active'], 1)
+            self.assertListEqual(datasets.evict_datasets(0, 0), [])
+            utils.get_data()
+            utils.INDEXES.pop('office')
+            self.assertIn(10, utils.get_weekday_aggregates())
+        self.assertEqual(datasets.USAGE['office']['active'], 0)
+        self.assertListEqual(datasets.evict_datasets(0, 0), ['office'])
+
+
+class HotUsersTestCase(unittest.TestCase):
+    """
+    Hot users tracking and prewarming tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_csv = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        self.hot_users = os.path.join(self.tmp_dir, 'hot_users.json')
+        main.app.config.update({
+            'DATA_CSV': self.data_csv,
+            'USERS_XML': TEST_DATA_XML,
+            'PREWARM': True,
+            'HOT_USERS_FILE': self.hot_users,
+        })
+        hot.HOT_USERS.counters.clear()
+        hot.PREWARMED.clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV, 'PREWARM': False})
+        main.app.config.pop('HOT_USERS_FILE')
+        hot.HOT_USERS.counters.clear()
+        hot.PREWARMED.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hot_users(self):
+        """
+        Test decaying counters and their persistence.
+        """
+        hot_users = hot.HotUsers(half_life=10)
+        for _ in xrange(4):
+            hot_users.record((None, 'trend_view', 10), now=0)
+        hot_users.record((None, 'trend_view', 11), now=20)
+        hot_users.record((None, 'trend_view', 11), now=20)
+        self.assertListEqual(hot_users.top(2, now=20), [
+            (None, 'trend_view', 11), (None, 'trend_view', 10)
+        ])
+        self.assertEqual(hot_users.decayed(4, 0, 20), 1)
+
+        hot_users.save(self.hot_users)
+        loaded = hot.HotUsers(half_life=10)
+        loaded.load(self.hot_users)
+        self.assertDictEqual(loaded.counters, hot_users.counters)
+        loaded.load(os.path.join(self.tmp_dir, 'missing.json'))
+        self.assertDictEqual(loaded.counters, hot_users.counters)
+
+        hot_users.trim(1, now=20)
+        self.assertListEqual(
+            hot_users.counters.keys(), [(None, 'trend_view', 11)]
+        )
+
+    def test_stale_while_refreshing(self):
+        """
+        Test results of previous generation are served while refreshing.
+        """
+        def refresher(dataset):  # pylint: disable=unused-argument
+            """
+            Pretends results of the dataset are refreshed in background.
+            """
+            return True
+
+        utils.REFRESHERS.insert(0, refresher)
+        try:
+            expected = utils.get_data()
+            with open(self.data_csv, 'a') as csv_file:
+                csv_file.write('\n12,2013-09-16,09:00:00,17:00:00\n')
+            with main.app.test_request_context():
+                self.assertIs(utils.get_data(), expected)
+                self.assertIn(12, utils.get_schedule_vectors()['users'])
+                self.assertIn(12, utils.get_data())
+        finally:
+            utils.REFRESHERS.remove(refresher)
+
+    def test_prewarm(self):
+        """
+        Test hot users are recomputed in background after data change.
+        """
+        for _ in xrange(3):
+            self.client.get('/api/v1/mean_time_weekday/11')
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/avatars/10')
+        self.client.get('/api/v1/presence_weekday/9')
+        self.assertListEqual(hot.HOT_USERS.top(5), [
+            (None, 'mean_time_weekday_view', 11),
+            (None, 'presence_weekday_view', 10),
+        ])
+        expected = self.client.get('/api/v1/mean_time_weekday/11').data
+
+        with open(self.data_csv, 'a') as csv_file:
+            csv_file.write('\n11,2013-09-16,09:00:00,17:00:00\n')
+        with main.app.test_request_context():
+            self.assertTrue(hot.start_prewarm(None))
+            thread = hot.PREWARMS.get(None)
+            if thread is not None:
+                thread.join()
+            self.assertFalse(hot.start_prewarm(None))
+            self.assertEqual(
+                utils.CACHE[hashlib.sha1('get_data').hexdigest()][
+                    'generation'], utils.data_generation()
+            )
+        self.assertNotEqual(
+            self.client.get('/api/v1/mean_time_weekday/11').data, expected
+        )
+        self.assertTrue(os.path.exists(self.hot_users))
+        self.assertListEqual(
+            hot.prewarm(main.app, None, 1), ['/api/v1/mean_time_weekday/11']
+        )
+        hot.HOT_USERS.record((None, 'removed_view', 10))
+        self.assertNotIn('removed_view', hot.prewarm(main.app, None, 5))
+
+    def test_notifier_waits_for_prewarm(self):
+        """
+        Test change of data is published after its prewarming finishes.
+        """
+        self.client.get('/api/v1/mean_time_weekday/11')
+        notifier = events.ChangeNotifier({
+            'data': (utils.data_generation, events.reloader(utils.get_data)),
+        })
+        notifier.generations = {'data': utils.data_generation()}
+        with open(self.data_csv, 'a') as csv_file:
+            csv_file.write('\n11,2013-09-16,09:00:00,17:00:00\n')
+        notifier.check()
+        self.assertEqual(len(notifier.wait(0, 0)), 1)
+        self.assertNotIn(None, hot.PREWARMS)
+        self.assertEqual(
+            hot.PREWARMED[None][0], utils.data_generation()
+        )
+
+
+class HarnessTestCase(unittest.TestCase):
+    """
+    Equivalence and speed-up harness tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'USERS_XML': TEST_DATA_XML})
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_generate_dataset(self):
+        """
+        Test generated dataset has malformed rows, duplicates and edges.
+        """
+        path = os.path.join(self.tmp_dir, 'data.csv')
+        user_ids = harness.generate_dataset(path, users=10, days=60, seed=1)
+        self.assertEqual(len(user_ids), 10)
+        self.assertEqual(
+            harness.generate_dataset(path, users=10, days=60, seed=1),
+            user_ids
+        )
+        quality = {'rows': 0, 'skipped': 0, 'rejected': 0, 'duplicates': 0}
+        data = utils.fan_out(
+            utils.parse_rows(utils.read_rows(path), quality), [], quality
+        )
+        self.assertListEqual(sorted(data), user_ids)
+        self.assertGreater(quality['skipped'], 1)
+        self.assertGreater(quality['rejected'], 0)
+        self.assertGreater(quality['duplicates'], 0)
+        self.assertTrue(any(
+            times['start'] == datetime.time(0, 0, 0)
+            for items in data.itervalues()
+            for times in items.itervalues()
+        ))
+
+    def test_verify(self):
+        """
+        Test fast paths match reference helpers and are timed.
+
+        Speed-ups depend on the machine, thresholds are tested by
+        test_slow_paths.
+        """
+        report = harness.verify(
+            main.app, self.tmp_dir, users=8, days=40, seed=2
+        )
+        self.assertListEqual(report['mismatches'], [])
+        self.assertEqual(len(report['timings']), 4)
+        self.assertEqual(main.app.config['DATA_CSV'], TEST_DATA_CSV)
+        self.assertFalse(main.app.config.get('LAZY_LOADING'))
+
+    def test_check_equivalence_isolated(self):
+        """
+        Test modes are compared in-process, without state of each other.
+        """
+        cache_path = os.path.join(self.tmp_dir, 'cache.sqlite')
+        main.app.config.update({
+            'PREWARM': True,
+            'CACHE_BACKEND': 'sqlite://' + cache_path,
+        })
+        admission.STALE_RESULTS[('users_view', (), (), (), None)] = ('', '')
+        try:
+            path = os.path.join(self.tmp_dir, 'data.csv')
+            user_ids = harness.generate_dataset(path, users=4, days=20)
+            self.assertListEqual(
+                harness.check_equivalence(
+                    main.app, path, user_ids, self.tmp_dir
+                ),
+                []
+            )
+            self.assertTrue(main.app.config['PREWARM'])
+            self.assertEqual(
+                main.app.config['CACHE_BACKEND'], 'sqlite://' + cache_path
+            )
+            self.assertDictEqual(dict(admission.STALE_RESULTS), {})
+            self.assertNotIn('sqlite://' + cache_path, utils.CACHE_BACKENDS)
+        finally:
+            main.app.config.update({'PREWARM': False})
+            main.app.config.pop('CACHE_BACKEND')
+            utils.CACHE_BACKENDS.clear()
+
+    def test_slow_paths(self):
+        """
+        Test fast paths below required speed-up are reported.
+        """
+        timings = [('fast', 1.0, 0.1), ('slow', 1.0, 0.8)]
+        self.assertListEqual(harness.slow_paths(timings, 2), ['slow'])
+        self.assertListEqual(harness.slow_paths(timings, 1), [])
+
+
+class CacheBackendsTestCase(unittest.TestCase):
+    """
+    Cache backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'USERS_XML': TEST_DATA_XML})
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('CACHE_BACKEND', None)
+        utils.CACHE_BACKENDS.clear()
+        utils.CACHE = {}
+        shutil.rmtree(self.tmp_dir)
+
+    def check_backend(self, backend):
+        """
+        Checks storing, expiring and missing entries.
+        """
+        entry = {'data': {10: [1, 2]}, 'time': 1, 'generation': ('a', 1)}
+        self.assertIsNone(backend.get('missing'))
+        backend.set('key', entry, 60000)
+        self.assertDictEqual(backend.get('key'), entry)
+        self.assertEqual(backend.stats['sets'], 1)
+
+    def test_sqlite_backend(self):
+        """
+        Test SQLite backend.
+        """
+        path = os.path.join(self.tmp_dir, 'cache.sqlite')
+        backend = cache_backends.create_backend('sqlite://' + path, dict)
+        self.check_backend(backend)
+        backend.set('expired', {'data': 1}, -1)
+        self.assertIsNone(backend.get('expired'))
+
+    def test_memcached_backend(self):
+        """
+        Test memcached protocol backend against a local stand-in.
+        """
+        server = start_memcached_stand_in()
+        try:
+            backend = cache_backends.create_backend(server.url, dict)
+            self.check_backend(backend)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        backend.disconnect()
+        self.assertIsNone(backend.get('key'))
+        self.assertEqual(backend.stats['errors'], 1)
+
+    def test_unknown_backend(self):
+        """
+        Test unknown backend URL.
+        """
+        with self.assertRaises(ValueError):
+            cache_backends.create_backend('redis://localhost', dict)
+
+    def test_shared_cache(self):
+        """
+        Test that a result computed by one worker is reused by another.
+        """
+        main.app.config.update({
+            'CACHE_BACKEND': 'sqlite://' + os.path.join(
+                self.tmp_dir, 'cache.sqlite'
+            )
+        })
+        expected = utils.get_users_from_xml()
+        backend = utils.get_cache_backend()
+        self.assertEqual(backend.stats['misses'], 1)
+        self.assertNotIn(
+            hashlib.sha1('get_users_from_xml').hexdigest(), utils.CACHE
+        )
+
+        # new backend instance and empty CACHE as in another process
+        utils.CACHE_BACKENDS.clear()
+        utils.CACHE = {}
+        self.assertEqual(utils.get_users_from_xml(), expected)
+        self.assertEqual(utils.get_cache_backend().stats['hits'], 1)
+        self.assertEqual(utils.get_cache_backend(local=True).stats, {
+            'hits': 0, 'misses': 0, 'stale': 0, 'sets': 0, 'errors': 0
+        })
+
+    def test_local_indexes(self):
+        """
+        Test that indexes stay in-process with a shared backend.
+        """
+        main.app.config.update({
+            'CACHE_BACKEND': 'sqlite://' + os.path.join(
+                self.tmp_dir, 'cache.sqlite'
+            )
+        })
+        for function in (utils.get_occupancy, utils.get_schedule_vectors,
+                         utils.get_trend_rollups, utils.get_company_rollup,
+                         utils.get_company_start_end_sketches):
+            function()
+            self.assertIn(
+                hashlib.sha1(function.__name__).hexdigest(), utils.CACHE
+            )
+        self.assertEqual(utils.get_cache_backend().stats['sets'], 0)
+
+    def test_shared_view_results(self):
+        """
+        Test that per-user and company results are shared with workers.
+        """
+        main.app.config.update({
+            'CACHE_BACKEND': 'sqlite://' + os.path.join(
+                self.tmp_dir, 'cache.sqlite'
+            )
+        })
+        client = main.app.test_client()
+        paths = [
+            '/api/v1/mean_time_weekday/10',
+            '/api/v1/mean_time_weekday/11',
+            '/api/v1/presence_start_end_percentiles/10',
+            '/api/v1/company/start_end_percentiles',
+        ]
+        expected = [client.get(path).data for path in paths]
+        self.assertEqual(utils.get_cache_backend().stats['sets'], 4)
+
+        utils.CACHE_BACKENDS.clear()
+        utils.CACHE = {}
+        self.assertEqual([client.get(path).data for path in paths], expected)
+        self.assertEqual(utils.get_cache_backend().stats['hits'], 4)
+        self.assertEqual(utils.get_cache_backend(local=True).stats['sets'], 0)
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+    """
+    Quantile sketch tests.
+    """
+
+    def test_exact_for_small_input(self):
+        """
+        Test that sketch is exact before first compaction.
+        """
+        sketch = sketches.QuantileSketch(k=16)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        for value in [5, 1, 4, 2, 3]:
+            sketch.update(value)
+        self.assertEqual(len(sketch), 5)
+        self.assertEqual(sketch.quantile(0.5), 3)
+        self.assertEqual(sketch.quantile(0.9), 5)
+        self.assertEqual(sketch.quantile(0), 1)
+
+    def test_approximation(self):
+        """
+        Test rank error of a compacted sketch.
+        """
+        generator = random.Random(0)
+        values = [generator.randint(0, 86399) for _ in xrange(20000)]
+        sketch = sketches.QuantileSketch()
+        for value in values:
+            sketch.update(value)
+        self.assertLess(sketch.size, 400)
+        values.sort()
+        for fraction in (0.1, 0.5, 0.9):
+            rank = values.index(sketch.quantile(fraction))
+            self.assertLess(abs(rank - fraction * len(values)), 400)
+
+    def test_merge(self):
+        """
+        Test merging sketches.
+        """
+        first, second = sketches.QuantileSketch(), sketches.QuantileSketch()
+        for value in xrange(1000):
+            first.update(value)
+            second.update(value + 1000)
+        merged = sketches.QuantileSketch().merge(first).merge(second)
+        self.assertEqual(len(merged), 2000)
+        self.assertEqual(len(first), 1000)
+        self.assertLess(abs(merged.quantile(0.5) - 1000), 40)
+
+
 def suite():
     """
     Default test suite.
@@ -387,6 +2188,17 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(MaterializeTestCase))
+    base_suite.addTest(unittest.makeSuite(AdmissionTestCase))
+    base_suite.addTest(unittest.makeSuite(ChangeNotifierTestCase))
+    base_suite.addTest(unittest.makeSuite(MemoryReportTestCase))
+    base_suite.addTest(unittest.makeSuite(AnalyzeTestCase))
+    base_suite.addTest(unittest.makeSuite(AvatarsTestCase))
+    base_suite.addTest(unittest.makeSuite(DatasetsTestCase))
+    base_suite.addTest(unittest.makeSuite(HotUsersTestCase))
+    base_suite.addTest(unittest.makeSuite(HarnessTestCase))
+    base_suite.addTest(unittest.makeSuite(CacheBackendsTestCase))
+    base_suite.addTest(unittest.makeSuite(QuantileSketchTestCase))
     return base_suite
 
 
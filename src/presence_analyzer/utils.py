@@ -3,58 +3,243 @@
 Helper functions used in views.
 """
 
+import bisect
+import bz2
 import csv
+import gzip
 import hashlib
+import io
+import json
 import logging
+import os
+import re
+import shutil
+import tempfile
 import threading
 import time
-from datetime import datetime, timedelta
+import urllib2
+from collections import OrderedDict
+from datetime import date as date_type, datetime, time as time_type, \
+    timedelta
 from functools import wraps
 from json import dumps
 
-from flask import Response
+import numpy
+from flask import Response, has_request_context, request
 from lxml import etree
 
+from presence_analyzer.cache_backends import create_backend
 from presence_analyzer.main import app
+from presence_analyzer.sketches import QuantileSketch
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 CACHE = {}
+CACHE_BACKENDS = {}
+INDEXES = {}
+DATASET_ENVIRON_KEY = 'presence_analyzer.dataset'
+PREWARM_ENVIRON_KEY = 'presence_analyzer.prewarm'
+USER_NOT_FOUND_ENVIRON_KEY = 'presence_analyzer.user_not_found'
+REFRESHERS = []
+INDEX_CACHE_DURATION = 3600 * 1000
+GENERATION_SUFFIX = '.generation'
+META_SUFFIX = '.meta'
+OFFSETS_SUFFIX = '.offsets'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+READ_BUFFER_SIZE = 64 * 1024
+TMP_PREFIX = '.tmp-'
+GZIP_MAGIC = '\x1f\x8b'
+BZIP2_MAGIC = 'BZh'
+SLOT_SECONDS = 15 * 60
+SLOTS_PER_DAY = 24 * 3600 / SLOT_SECONDS
+TREND_GRANULARITIES = ('day', 'week', 'month')
+DATE_PATTERN = re.compile(r'(\d{4})-(\d\d)-(\d\d)\Z')
+TIME_PATTERN = re.compile(r'(\d\d):(\d\d):(\d\d)\Z')
+LAZY_USERS = OrderedDict()
+LAZY_USERS_LOCK = threading.Lock()
+TREND_ROLLUPS = {}
+COMPUTING = threading.local()
 
 
 def lock(function):
     """
     Decorator for preventing using a function at the same time.
     """
+    function_lock = threading.RLock()
+
     @wraps(function)
     def inner(*args, **kwargs):  # pylint: disable=missing-docstring
-        with threading.Lock():
+        with function_lock:
             return function(*args, **kwargs)
     return inner
 
 
-def cache(duration):
+def cache(duration, generation=None, local=False):
     """
     Decorator for caching the result of a function.
+
+    Results of different arguments and of named datasets are kept apart.
+    Optional `generation` callable returns a token of the source data,
+    cached result is dropped as soon as the token changes. Results are kept
+    in the backend chosen by CACHE_BACKEND setting, `local` results always
+    stay in the in-process CACHE. Indexes read by every request are local,
+    a shared backend would unpickle them each time.
+
+    Only one thread computes the result, others wait for it. Result of
+    a previous generation is still returned while one of REFRESHERS
+    recomputes it in background, but never to a call nested in another
+    computation: its result is stored as of the current generation.
     """
     def decorator(function):  # pylint: disable=missing-docstring
-        @wraps(function)
-        def inner(*args, **kwargs):  # pylint: disable=missing-docstring
-            key = hashlib.sha1(function.__name__).hexdigest()
+        def is_fresh(entry, current_time, current_generation):
+            """
+            Tells whether entry may be returned as it is.
+            """
+            return entry is not None and \
+                current_time - entry['time'] < duration and \
+                entry.get('generation') == current_generation
+
+        @lock
+        def compute(key, backend, current_generation, args, kwargs):
+            """
+            Computes and stores result unless other thread just did it.
+            """
             current_time = int(time.time() * 1000)
-            if key in CACHE and current_time - CACHE[key]['time'] < duration:
-                return CACHE[key]['data']
+            entry = backend.get(key)
+            if is_fresh(entry, current_time, current_generation):
+                backend.stats['hits'] += 1
+                return entry['data']
 
-            result = function(*args, **kwargs)
-            CACHE[key] = {
+            backend.stats['misses'] += 1
+            COMPUTING.depth = getattr(COMPUTING, 'depth', 0) + 1
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                COMPUTING.depth -= 1
+            backend.set(key, {
+                'name': function.__name__,
                 'data': result,
-                'time': current_time
-            }
+                'time': current_time,
+                'generation': current_generation,
+                'dataset': current_dataset(),
+            }, duration)
             return result
+
+        @wraps(function)
+        def inner(*args, **kwargs):  # pylint: disable=missing-docstring
+            dataset = current_dataset()
+            name = function.__name__
+            if args or kwargs:
+                name = '{}{!r}{!r}'.format(
+                    name, args, sorted(kwargs.iteritems())
+                )
+            if dataset is not None:
+                name = '{}@{}'.format(name, dataset)
+            key = hashlib.sha1(name).hexdigest()
+            current_time = int(time.time() * 1000)
+            current_generation = generation() if generation else None
+            backend = get_cache_backend(local)
+            entry = backend.get(key)
+            if is_fresh(entry, current_time, current_generation):
+                backend.stats['hits'] += 1
+                return entry['data']
+            if entry is not None and generation is not None and \
+                    current_time - entry['time'] < duration and \
+                    not getattr(COMPUTING, 'depth', 0) and \
+                    refresh_in_background():
+                backend.stats['stale'] += 1
+                return entry['data']
+            return compute(key, backend, current_generation, args, kwargs)
         return inner
     return decorator
 
 
+def is_prewarming():
+    """
+    Tells whether current request recomputes results in background.
+    """
+    return has_request_context() and \
+        bool(request.environ.get(PREWARM_ENVIRON_KEY))
+
+
+def refresh_in_background():
+    """
+    Asks REFRESHERS to recompute results of current dataset in background.
+
+    Returns True if one of them does, so results of the previous
+    generation may be served meanwhile.
+    """
+    if is_prewarming():
+        return False
+    dataset = current_dataset()
+    return any(refresher(dataset) for refresher in REFRESHERS)
+
+
+def get_cache_backend(local=False):
+    """
+    Returns cache backend configured by CACHE_BACKEND setting.
+    """
+    url = 'memory' if local else app.config.get('CACHE_BACKEND', 'memory')
+    if url not in CACHE_BACKENDS:
+        CACHE_BACKENDS[url] = create_backend(url, lambda: CACHE)
+    return CACHE_BACKENDS[url]
+
+
+def current_dataset():
+    """
+    Returns name of the dataset requested by the current request.
+
+    None stands for the default dataset configured by DATA_CSV and
+    USERS_XML settings, also used outside of requests.
+    """
+    if not has_request_context():
+        return None
+    return request.environ.get(DATASET_ENVIRON_KEY)
+
+
+def dataset_setting(name):
+    """
+    Returns setting of the current dataset.
+    """
+    dataset = current_dataset()
+    if dataset is None:
+        return app.config[name]
+    return app.config['DATASETS'][dataset][name]
+
+
+def get_indexes():
+    """
+    Returns INDEXES of the current dataset.
+
+    A dataset evicted after get_data() returned its cached result is
+    loaded again.
+    """
+    dataset = current_dataset()
+    indexes = INDEXES.get(dataset)
+    if indexes is None:
+        log.info('Reloading evicted dataset %s', dataset)
+        evict_dataset(dataset)
+        get_data()
+        indexes = INDEXES[dataset]
+    return indexes
+
+
+def evict_dataset(dataset):
+    """
+    Drops in-process cache entries, INDEXES and lazily loaded users of
+    given dataset.
+    """
+    for key, entry in CACHE.items():
+        if entry.get('dataset') == dataset:
+            CACHE.pop(key, None)
+    INDEXES.pop(dataset, None)
+    TREND_ROLLUPS.pop(dataset, None)
+    with LAZY_USERS_LOCK:
+        for key in LAZY_USERS.keys():
+            if key[0] == dataset:
+                del LAZY_USERS[key]
+
+
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
@@ -71,6 +256,171 @@ def jsonify(function):
     return inner
 
 
+def get_generation(path):
+    """
+    Returns generation counter of given data file, zero if never bumped.
+    """
+    try:
+        with open(path + GENERATION_SUFFIX, 'r') as generation_file:
+            return int(generation_file.read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def bump_generation(path):
+    """
+    Increments generation counter of given data file.
+
+    Counter is shared by all workers through a file next to the data file,
+    so every process notices that its cached copy is outdated.
+    """
+    generation = get_generation(path) + 1
+    atomic_write(path + GENERATION_SUFFIX, str(generation))
+    return generation
+
+
+def data_generation():
+    """
+    Returns generation token of the presence CSV file of current dataset.
+    """
+    path = dataset_setting('DATA_CSV')
+    stat = os.stat(path)
+    return path, get_generation(path), stat.st_mtime, stat.st_size
+
+
+def users_generation():
+    """
+    Returns generation token of the users XML file of current dataset.
+    """
+    path = dataset_setting('USERS_XML')
+    return path, get_generation(path)
+
+
+def read_umask():
+    """
+    Returns umask of the process.
+
+    Umask can be read only by setting it, which is not thread-safe, so it
+    is read once at import time.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+FILE_MODE = 0o644 & ~read_umask()
+
+
+def make_tmp_file(path, suffix=''):
+    """
+    Creates temporary file next to given path, returns its handle and path.
+
+    mkstemp() creates files readable only by the owner, their mode is set
+    as of files created by open() so renamed files stay readable by the
+    front web server.
+    """
+    handle, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=TMP_PREFIX,
+        suffix=suffix
+    )
+    os.fchmod(handle, FILE_MODE)
+    return handle, tmp_path
+
+
+def atomic_write(path, content):
+    """
+    Writes content to a temporary file and renames it over given path.
+    """
+    handle, tmp_path = make_tmp_file(path)
+    try:
+        with os.fdopen(handle, 'wb') as tmp_file:
+            tmp_file.write(content)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def validate_users_xml(path):
+    """
+    Incrementally parses users XML and checks its structure.
+
+    Raises ValueError if file is malformed or lacks required elements.
+    """
+    found = set()
+    users = 0
+    try:
+        for _, element in etree.iterparse(path, events=('end',)):
+            if element.tag == 'user':
+                if element.get('id') is None:
+                    raise ValueError('User without id in {}'.format(path))
+                users += 1
+                element.clear()
+            elif element.tag in ('protocol', 'host', 'users'):
+                found.add(element.tag)
+    except etree.XMLSyntaxError as error:
+        raise ValueError('Malformed users XML: {}'.format(error))
+
+    missing = {'protocol', 'host', 'users'} - found
+    if missing:
+        raise ValueError('Missing elements in users XML: {}'.format(
+            ', '.join(sorted(missing))
+        ))
+    return users
+
+
+def update_users_xml(url, path, timeout=30):
+    """
+    Downloads users XML to given path if it was changed on the server.
+
+    Uses conditional request headers, streams response to a temporary file,
+    validates it and renames it into place atomically. Returns True if file
+    was replaced.
+    """
+    meta_path = path + META_SUFFIX
+    try:
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+    except (IOError, ValueError):
+        meta = {}
+
+    request = urllib2.Request(url)
+    if os.path.exists(path):
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            log.debug('%s not modified', url)
+            return False
+        raise
+
+    handle, tmp_path = make_tmp_file(path, '.xml')
+    try:
+        with os.fdopen(handle, 'wb') as tmp_file:
+            shutil.copyfileobj(response, tmp_file, DOWNLOAD_CHUNK_SIZE)
+        validate_users_xml(tmp_path)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    finally:
+        response.close()
+
+    atomic_write(meta_path, json.dumps({
+        'etag': response.info().getheader('ETag'),
+        'last_modified': response.info().getheader('Last-Modified'),
+    }))
+    bump_generation(path)
+    return True
+
+
+@cache(600, generation=users_generation)
 def get_users_from_xml():
     """
     Extracts user informations from user.xml and groups it by user_id.
@@ -86,7 +436,7 @@ def get_users_from_xml():
             'name': u'Kamil G.'
         }
     """
-    tree = etree.parse(app.config['USERS_XML'])
+    tree = etree.parse(dataset_setting('USERS_XML'))
     api_url = '{}://{}'.format(
         tree.find('server').find('protocol').text,
         tree.find('server').find('host').text
@@ -100,12 +450,17 @@ def get_users_from_xml():
     return result
 
 
-@lock
-@cache(600)
+@cache(INDEX_CACHE_DURATION, generation=data_generation, local=True)
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
+    File is read once, every entry is also fed to INGEST_SINKS which build
+    INDEXES of the current dataset used by the other views, start and end
+    sketches are built from the result. As INDEXES
+    belong to the process the result is never kept in a shared cache
+    backend.
+
     It creates structure like this:
     data = {
         'user_id': {
@@ -120,27 +475,769 @@ def get_data():
         }
     }
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    path = dataset_setting('DATA_CSV')
+    sinks = {name: sink() for name, sink in INGEST_SINKS.iteritems()}
+    quality = {'rows': 0, 'skipped': 0, 'rejected': 0, 'duplicates': 0}
+    data = fan_out(
+        parse_rows(read_rows(path), quality),
+        sinks.values(),
+        quality
+    )
+    indexes = {name: sink.result() for name, sink in sinks.iteritems()}
+    indexes['start_end_sketches'] = build_start_end_sketches(data)
+    indexes['data_quality'] = quality
+    INDEXES[current_dataset()] = indexes
+    if quality['rejected']:
+        log.warning(
+            'Rejected %d of %d rows of %s',
+            quality['rejected'], quality['rows'], path
+        )
+    return data
 
+
+def open_data_file(path):
+    """
+    Opens plain, gzip or bzip2 compressed file for streaming reading.
+
+    Compression is detected by magic bytes, compressed files are
+    decompressed on the fly without a temporary copy.
+    """
+    compression = detect_compression(path)
+    if compression == 'gzip':
+        return io.BufferedReader(gzip.open(path, 'rb'), READ_BUFFER_SIZE)
+    if compression == 'bzip2':
+        return bz2.BZ2File(path, 'r', READ_BUFFER_SIZE)
+    return open(path, 'r')
+
+
+def detect_compression(path):
+    """
+    Returns 'gzip' or 'bzip2' by magic bytes of the file, None if plain.
+    """
+    with open(path, 'rb') as data_file:
+        magic = data_file.read(3)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == BZIP2_MAGIC:
+        return 'bzip2'
+    return None
+
+
+def build_offset_index(path):
+    """
+    Scans plain CSV file and maps user_id to byte ranges of user's lines.
+
+    Ranges of consecutive lines are merged, so a file sorted by user has
+    a single range per user. Lines without numeric user_id are left out.
+    """
+    index = {}
+    offset = 0
+    with open(path, 'rb') as data_file:
+        for line in data_file:
+            end = offset + len(line)
             try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+                user_id = int(line.split(',', 1)[0])
+            except ValueError:
+                offset = end
+                continue
+            ranges = index.setdefault(user_id, [])
+            if ranges and ranges[-1][1] == offset:
+                ranges[-1][1] = end
+            else:
+                ranges.append([offset, end])
+            offset = end
+    return index
+
+
+@cache(INDEX_CACHE_DURATION, generation=data_generation, local=True)
+def get_offset_index():
+    """
+    Returns byte ranges of users' lines in the CSV file of current dataset.
+
+    Ranges are returned under 'users' key together with 'generation' of
+    the file they were found in. Index is persisted next to the CSV file
+    and reused by other processes until the file changes. Compressed files
+    cannot be read at an offset, None is returned for them.
+    """
+    path = dataset_setting('DATA_CSV')
+    if detect_compression(path) is not None:
+        log.info('Lazy loading of compressed %s is not possible', path)
+        return None
+    generation = list(data_generation()[1:])
+    try:
+        with open(path + OFFSETS_SUFFIX, 'r') as offsets_file:
+            stored = json.load(offsets_file)
+        if stored['generation'] == generation:
+            return {
+                'generation': generation,
+                'users': {
+                    int(user_id): ranges
+                    for user_id, ranges in stored['users'].iteritems()
+                },
+            }
+    except (IOError, ValueError, KeyError):
+        log.debug('No valid offset index of %s', path)
+
+    index = build_offset_index(path)
+    try:
+        atomic_write(path + OFFSETS_SUFFIX, json.dumps({
+            'generation': generation,
+            'users': index,
+        }))
+    except (IOError, OSError):
+        log.warning('Cannot persist offset index of %s', path, exc_info=True)
+    return {'generation': generation, 'users': index}
+
+
+def read_user_rows(path, ranges):
+    """
+    Yields rows of a CSV file found in given byte ranges.
+
+    Rows are numbered by offset of their range.
+    """
+    with open(path, 'rb') as data_file:
+        for start, end in ranges:
+            data_file.seek(start)
+            lines = data_file.read(end - start).splitlines()
+            for row in csv.reader(lines, delimiter=','):
+                yield start, row
+
+
+def load_user(user_id):
+    """
+    Returns INDEXES of a single user built only from the user's lines.
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+    Results of recently used users are kept in LAZY_USERS, at most
+    LAZY_USERS_SIZE of them. Returns None if the CSV file cannot be read
+    at an offset or the offset index is not up to date yet.
+    """
+    generation = data_generation()
+    index = get_offset_index()
+    if index is None or index['generation'] != list(generation[1:]):
+        return None
+    key = (current_dataset(), generation, user_id)
+    with LAZY_USERS_LOCK:
+        if key in LAZY_USERS:
+            LAZY_USERS[key] = LAZY_USERS.pop(key)
+            return LAZY_USERS[key]
+
+    sinks = {name: sink() for name, sink in INGEST_SINKS.iteritems()}
+    quality = {'rows': 0, 'skipped': 0, 'rejected': 0, 'duplicates': 0}
+    data = fan_out(
+        parse_rows(
+            read_user_rows(
+                dataset_setting('DATA_CSV'), index['users'].get(user_id, [])
+            ),
+            quality
+        ),
+        sinks.values(),
+        quality
+    )
+    indexes = {name: sink.result() for name, sink in sinks.iteritems()}
+    indexes['start_end_sketches'] = build_start_end_sketches(data)
+    with LAZY_USERS_LOCK:
+        LAZY_USERS[key] = indexes
+        while len(LAZY_USERS) > app.config.get('LAZY_USERS_SIZE', 256):
+            LAZY_USERS.popitem(last=False)
+    return indexes
+
+
+def get_user_index(name, user_id):
+    """
+    Returns entry of a given user in index `name`, None if user is unknown.
+
+    With LAZY_LOADING setting enabled only lines of the user are read
+    instead of the whole CSV file.
+    """
+    indexes = None
+    if app.config.get('LAZY_LOADING'):
+        indexes = load_user(user_id)
+    if indexes is None:
+        get_data()
+        indexes = get_indexes()
+    return indexes[name].get(user_id)
 
+
+def read_rows(path):
+    """
+    Yields numbered rows of a CSV file.
+    """
+    with open_data_file(path) as csvfile:
+        for i, row in enumerate(csv.reader(csvfile, delimiter=',')):
+            yield i, row
+
+
+def parse_date(value):
+    """
+    Parses YYYY-MM-DD date, same as strptime() but faster for well-formed
+    values. Raises ValueError for invalid ones.
+    """
+    match = DATE_PATTERN.match(value)
+    if match is not None:
+        try:
+            return date_type(*[int(part) for part in match.groups()])
+        except ValueError:
+            pass
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def parse_time(value):
+    """
+    Parses HH:MM:SS time, same as strptime() but faster for well-formed
+    values. Raises ValueError for invalid ones.
+    """
+    match = TIME_PATTERN.match(value)
+    if match is not None:
+        try:
+            return time_type(*[int(part) for part in match.groups()])
+        except ValueError:
+            pass
+    return datetime.strptime(value, '%H:%M:%S').time()
+
+
+def parse_rows(rows, quality):
+    """
+    Parses and validates rows, yields (user_id, date, start, end) tuples.
+
+    Header, footer and malformed rows are counted in `quality` and dropped.
+    Dates repeat for every user, so each one is parsed once.
+    """
+    dates = {}
+    for i, row in rows:
+        quality['rows'] += 1
+        if len(row) != 4:
+            # ignore header and footer lines
+            quality['skipped'] += 1
+            continue
+
+        try:
+            user_id = int(row[0])
+            date = dates.get(row[1])
+            if date is None:
+                date = dates[row[1]] = parse_date(row[1])
+            start = parse_time(row[2])
+            end = parse_time(row[3])
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            quality['rejected'] += 1
+            continue
+
+        yield user_id, date, start, end
+
+
+def fan_out(entries, sinks, quality):
+    """
+    Builds per-user presence store and feeds every entry to all sinks.
+
+    Later entry of a duplicated date replaces the earlier one, sinks get
+    the replaced entry as `previous`.
+    """
+    data = {}
+    for user_id, date, start, end in entries:
+        items = data.setdefault(user_id, {})
+        previous = items.get(date)
+        if previous is not None:
+            quality['duplicates'] += 1
+        items[date] = {'start': start, 'end': end}
+        for sink in sinks:
+            sink.add(user_id, date, start, end, previous)
     return data
 
 
+def build_start_end_sketches(data):
+    """
+    Builds start and end quantile sketches per user and weekday.
+
+    Sketches cannot forget values, so unlike INGEST_SINKS they are built
+    from the store of fan_out() where duplicated dates are already
+    replaced by their last entry.
+    """
+    sketches = {}
+    for user_id, items in data.iteritems():
+        weekdays = sketches[user_id] = [
+            {'start': QuantileSketch(), 'end': QuantileSketch()}
+            for _ in xrange(7)
+        ]
+        for date, times in items.iteritems():
+            weekday = weekdays[date.weekday()]
+            weekday['start'].update(seconds_since_midnight(times['start']))
+            weekday['end'].update(seconds_since_midnight(times['end']))
+    return sketches
+
+
+class WeekdayAggregateSink(object):
+    """
+    Sums presence, start and end seconds per user and weekday.
+    """
+
+    def __init__(self):
+        self.users = {}
+
+    def add(self, user_id, date, start, end, previous):
+        """
+        Adds a single presence entry, replacing the previous one.
+        """
+        weekday = self.users.setdefault(user_id, [
+            {'count': 0, 'presence': 0, 'start': 0, 'end': 0}
+            for _ in xrange(7)
+        ])[date.weekday()]
+        if previous is not None:
+            weekday['count'] -= 1
+            weekday['presence'] -= interval(
+                previous['start'], previous['end']
+            )
+            weekday['start'] -= seconds_since_midnight(previous['start'])
+            weekday['end'] -= seconds_since_midnight(previous['end'])
+        weekday['count'] += 1
+        weekday['presence'] += interval(start, end)
+        weekday['start'] += seconds_since_midnight(start)
+        weekday['end'] += seconds_since_midnight(end)
+
+    def result(self):
+        """
+        Returns aggregates grouped by user and weekday.
+        """
+        return self.users
+
+
+class DailyPresenceSink(object):
+    """
+    Collects presence seconds per user and date for trend rollups.
+    """
+
+    def __init__(self):
+        self.users = {}
+
+    def add(self, user_id, date, start, end, previous):
+        """
+        Adds a single presence entry.
+        """
+        # pylint: disable=unused-argument
+        self.users.setdefault(user_id, {})[date] = interval(start, end)
+
+    def result(self):
+        """
+        Returns presence seconds grouped by user and date.
+        """
+        return self.users
+
+
+INGEST_SINKS = {
+    'weekday_aggregates': WeekdayAggregateSink,
+    'daily_presence': DailyPresenceSink,
+}
+
+
+def get_weekday_aggregates():
+    """
+    Returns presence sums grouped by user and weekday.
+
+    Aggregates are built by get_data() while the CSV file is read.
+    """
+    get_data()
+    return get_indexes()['weekday_aggregates']
+
+
+def weekday_means(weekdays, field):
+    """
+    Calculates mean of summed field for every weekday aggregate.
+    """
+    return [
+        float(weekday[field]) / weekday['count'] if weekday['count'] else 0
+        for weekday in weekdays
+    ]
+
+
+def get_data_quality():
+    """
+    Returns counters of skipped, rejected and duplicated CSV rows.
+    """
+    get_data()
+    return get_indexes()['data_quality']
+
+
+def get_start_end_sketches():
+    """
+    Returns start and end quantile sketches grouped by user and weekday.
+
+    Sketches are built by get_data() while the CSV file is read.
+    """
+    get_data()
+    return get_indexes()['start_end_sketches']
+
+
+def merge_start_end_sketches(users_sketches):
+    """
+    Merges start and end sketches of many users weekday by weekday.
+    """
+    result = [
+        {'start': QuantileSketch(), 'end': QuantileSketch()}
+        for _ in xrange(7)
+    ]
+    for weekdays in users_sketches:
+        for merged, weekday in zip(result, weekdays):
+            merged['start'].merge(weekday['start'])
+            merged['end'].merge(weekday['end'])
+    return result
+
+
+def start_end_percentiles(weekdays):
+    """
+    Returns median and 90th percentile of start and end for every weekday.
+    """
+    return [
+        (
+            sketches['start'].quantile(0.5),
+            sketches['end'].quantile(0.5),
+            sketches['start'].quantile(0.9),
+            sketches['end'].quantile(0.9),
+        )
+        for sketches in weekdays
+    ]
+
+
+@cache(INDEX_CACHE_DURATION, generation=data_generation, local=True)
+def get_company_start_end_sketches():
+    """
+    Returns start and end sketches of all users merged by weekday.
+    """
+    return merge_start_end_sketches(get_start_end_sketches().itervalues())
+
+
+@cache(INDEX_CACHE_DURATION, generation=data_generation)
+def get_company_start_end_percentiles():
+    """
+    Returns start and end percentiles of all users for every weekday.
+    """
+    return start_end_percentiles(get_company_start_end_sketches())
+
+
+@cache(INDEX_CACHE_DURATION, generation=data_generation)
+def get_user_start_end_percentiles(user_id):
+    """
+    Returns start and end percentiles of a given user for every weekday,
+    None if user is unknown.
+    """
+    sketches = get_user_index('start_end_sketches', user_id)
+    if sketches is None:
+        return None
+    return start_end_percentiles(sketches)
+
+
+@cache(INDEX_CACHE_DURATION, generation=data_generation)
+def get_user_weekdays(user_id):
+    """
+    Returns total presence and mean presence, start and end of a given
+    user for every weekday, None if user is unknown.
+
+    Unlike indexes these few numbers are shared by workers.
+    """
+    weekdays = get_user_index('weekday_aggregates', user_id)
+    if weekdays is None:
+        return None
+    return {
+        'total_presence': [weekday['presence'] for weekday in weekdays],
+        'presence': weekday_means(weekdays, 'presence'),
+        'start': weekday_means(weekdays, 'start'),
+        'end': weekday_means(weekdays, 'end'),
+    }
+
+
+def presence_columns(data):
+    """
+    Flattens presence entries into columns for vectorized computations.
+
+    Returns numpy arrays of user ids, weekdays, start and end seconds.
+    """
+    size = sum(len(items) for items in data.itervalues())
+    rows = numpy.fromiter(
+        (
+            value
+            for user_id, items in data.iteritems()
+            for date, times in items.iteritems()
+            for value in (
+                user_id,
+                date.weekday(),
+                seconds_since_midnight(times['start']),
+                seconds_since_midnight(times['end']),
+            )
+        ),
+        dtype=numpy.int64,
+        count=size * 4
+    ).reshape(size, 4)
+    return rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3]
+
+
+@cache(INDEX_CACHE_DURATION, generation=data_generation, local=True)
+def get_company_rollup():
+    """
+    Aggregates presence of all users in one vectorized pass.
+
+    Returns mean presence in seconds per weekday and numbers of arrivals
+    and departures in every SLOT_SECONDS long slot of a day.
+    """
+    _, weekdays, starts, ends = presence_columns(get_data())
+    totals = numpy.bincount(weekdays, weights=ends - starts, minlength=7)
+    counts = numpy.bincount(weekdays, minlength=7)
+    means = numpy.zeros(7)
+    numpy.divide(totals, counts, out=means, where=counts > 0)
+    return {
+        'mean_presence': means.tolist(),
+        'arrivals': numpy.bincount(
+            starts // SLOT_SECONDS, minlength=SLOTS_PER_DAY
+        ).tolist(),
+        'departures': numpy.bincount(
+            ends // SLOT_SECONDS, minlength=SLOTS_PER_DAY
+        ).tolist(),
+    }
+
+
+@cache(INDEX_CACHE_DURATION, generation=data_generation, local=True)
+def get_occupancy():
+    """
+    Precomputes office occupancy of all users.
+
+    Returns mean number of people present in every SLOT_SECONDS long slot
+    of every weekday, built with a difference array, and an index of
+    presence intervals sorted by start for every date.
+    """
+    data = get_data()
+    weekdays, firsts, lasts = [], [], []
+    days = {}
+    for user_id, items in data.iteritems():
+        for date, times in items.iteritems():
+            start = seconds_since_midnight(times['start'])
+            end = seconds_since_midnight(times['end'])
+            weekdays.append(date.weekday())
+            firsts.append(start // SLOT_SECONDS)
+            lasts.append((end - 1) // SLOT_SECONDS + 1)
+            days.setdefault(date, []).append((start, end, user_id))
+
+    weekdays = numpy.array(weekdays, dtype=numpy.int64)
+    firsts = numpy.array(firsts, dtype=numpy.int64)
+    lasts = numpy.maximum(numpy.array(lasts, dtype=numpy.int64), firsts)
+    changes = numpy.zeros((7, SLOTS_PER_DAY + 1))
+    numpy.add.at(changes, (weekdays, firsts), 1)
+    numpy.add.at(changes, (weekdays, lasts), -1)
+    dates = numpy.bincount(
+        numpy.array([date.weekday() for date in days], dtype=numpy.int64),
+        minlength=7
+    )
+    heatmap = numpy.cumsum(changes, axis=1)[:, :SLOTS_PER_DAY]
+    heatmap /= numpy.maximum(dates, 1)[:, numpy.newaxis]
+
+    index = {}
+    for date, intervals in days.iteritems():
+        intervals.sort()
+        index[date] = (
+            [start for start, _, _ in intervals],
+            [end for _, end, _ in intervals],
+            [user_id for _, _, user_id in intervals],
+        )
+    return {'heatmap': heatmap.tolist(), 'index': index}
+
+
+@cache(INDEX_CACHE_DURATION, generation=data_generation, local=True)
+def get_schedule_vectors():
+    """
+    Builds matrix of weekly presence vectors of all users.
+
+    Row of a user holds, for every weekday and SLOT_SECONDS long slot,
+    a fraction of the user's days of that weekday spent in the office in
+    that slot. Rows are normalized, so their dot product is the cosine
+    similarity of two schedules.
+    """
+    user_ids, weekdays, starts, ends = presence_columns(get_data())
+    users = sorted(set(user_ids.tolist()))
+    rows = numpy.searchsorted(users, user_ids)
+    firsts = starts // SLOT_SECONDS
+    lasts = numpy.maximum((ends - 1) // SLOT_SECONDS + 1, firsts)
+
+    changes = numpy.zeros((len(users), 7, SLOTS_PER_DAY + 1))
+    numpy.add.at(changes, (rows, weekdays, firsts), 1)
+    numpy.add.at(changes, (rows, weekdays, lasts), -1)
+    days = numpy.zeros((len(users), 7))
+    numpy.add.at(days, (rows, weekdays), 1)
+    matrix = numpy.cumsum(changes, axis=2)[:, :, :SLOTS_PER_DAY]
+    matrix /= numpy.maximum(days, 1)[:, :, numpy.newaxis]
+    matrix = matrix.reshape(len(users), 7 * SLOTS_PER_DAY)
+    norms = numpy.linalg.norm(matrix, axis=1)
+    matrix /= numpy.maximum(norms, 1e-12)[:, numpy.newaxis]
+    return {'users': users, 'matrix': matrix}
+
+
+def similar_users(vectors, user_id, count):
+    """
+    Returns up to `count` (user_id, similarity) pairs most similar to user.
+
+    Similarities of all users come from one matrix-vector product.
+    """
+    row = bisect.bisect_left(vectors['users'], user_id)
+    scores = vectors['matrix'].dot(vectors['matrix'][row])
+    scores[row] = -numpy.inf
+    count = min(count, len(scores) - 1)
+    if count <= 0:
+        return []
+    best = numpy.argpartition(-scores, count - 1)[:count]
+    best = best[numpy.argsort(-scores[best], kind='mergesort')]
+    return [(vectors['users'][i], float(scores[i])) for i in best]
+
+
+def present_at(occupancy, moment):
+    """
+    Returns sorted ids of users present in the office at given datetime.
+    """
+    if moment.date() not in occupancy['index']:
+        return []
+    starts, ends, user_ids = occupancy['index'][moment.date()]
+    second = seconds_since_midnight(moment.time())
+    return sorted(
+        user_ids[i]
+        for i in xrange(bisect.bisect_right(starts, second))
+        if ends[i] > second
+    )
+
+
+def build_trend_rollup(days):
+    """
+    Builds prefix sums of presence seconds for consecutive days.
+
+    `days` maps dates to presence seconds. Sum of any window of days is
+    a difference of two prefix sums.
+    """
+    first, last = min(days), max(days)
+    totals = numpy.zeros(last.toordinal() - first.toordinal() + 1)
+    for date, seconds in days.iteritems():
+        totals[date.toordinal() - first.toordinal()] = seconds
+    return {
+        'first': first,
+        'last': last,
+        'prefix': numpy.concatenate(([0], numpy.cumsum(totals))),
+    }
+
+
+def update_trend_rollup(rollup, previous_days, days):
+    """
+    Returns rollup of `days` reusing `rollup` built from `previous_days`.
+
+    The rollup is returned as it is when days did not change and extended
+    when days were only appended after its last day, otherwise it is built
+    again.
+    """
+    if rollup is None:
+        return build_trend_rollup(days)
+    if days == previous_days:
+        return rollup
+    appended = days.viewkeys() - previous_days.viewkeys()
+    if not appended or min(appended) <= rollup['last'] or \
+            not previous_days.viewitems() <= days.viewitems():
+        return build_trend_rollup(days)
+    last = max(appended)
+    offset = rollup['last'].toordinal() + 1
+    totals = numpy.zeros(last.toordinal() - offset + 1)
+    for date in appended:
+        totals[date.toordinal() - offset] = days[date]
+    return {
+        'first': rollup['first'],
+        'last': last,
+        'prefix': numpy.concatenate((
+            rollup['prefix'], rollup['prefix'][-1] + numpy.cumsum(totals)
+        )),
+    }
+
+
+@cache(INDEX_CACHE_DURATION, generation=data_generation, local=True)
+def get_trend_rollups():
+    """
+    Returns trend rollups of all users.
+
+    Daily presence is collected by get_data() while the CSV file is read.
+    Rollups of the previous generation are kept in TREND_ROLLUPS, so only
+    users with changed days are rolled up again and appended days only
+    extend their rollups.
+    """
+    get_data()
+    dataset = current_dataset()
+    daily_presence = get_indexes()['daily_presence']
+    previous = TREND_ROLLUPS.get(dataset, {'days': {}, 'rollups': {}})
+    rollups = {
+        user_id: update_trend_rollup(
+            previous['rollups'].get(user_id),
+            previous['days'].get(user_id),
+            days
+        )
+        for user_id, days in daily_presence.iteritems()
+    }
+    TREND_ROLLUPS[dataset] = {'days': daily_presence, 'rollups': rollups}
+    return rollups
+
+
+def get_user_trend_rollup(user_id):
+    """
+    Returns trend rollup of a given user, None if user is unknown.
+    """
+    if not app.config.get('LAZY_LOADING'):
+        return get_trend_rollups().get(user_id)
+    days = get_user_index('daily_presence', user_id)
+    return build_trend_rollup(days) if days is not None else None
+
+
+def period_start(date, granularity):
+    """
+    Returns first day of a day, week or month period containing date.
+    """
+    if granularity == 'week':
+        return date - timedelta(days=date.weekday())
+    if granularity == 'month':
+        return date.replace(day=1)
+    return date
+
+
+def next_period(date, granularity):
+    """
+    Returns first day of the period following the one starting at date.
+    """
+    if granularity == 'week':
+        return date + timedelta(days=7)
+    if granularity == 'month':
+        if date.month == 12:
+            return date_type(date.year + 1, 1, 1)
+        return date_type(date.year, date.month + 1, 1)
+    return date + timedelta(days=1)
+
+
+def trend(rollup, granularity, start=None, end=None):
+    """
+    Sums presence seconds per period of given granularity.
+
+    Returns list of (period start, seconds) tuples for periods overlapping
+    the window, only days inside the window are summed. Windows outside
+    of the rollup or reversed ones give an empty list.
+    """
+    start = max(start or rollup['first'], rollup['first'])
+    end = min(end or rollup['last'], rollup['last'])
+    if start > end:
+        return []
+    offset = rollup['first'].toordinal()
+    prefix = rollup['prefix']
+    result = []
+    period = period_start(start, granularity)
+    while period <= end:
+        following = next_period(period, granularity)
+        low = max(period, start).toordinal() - offset
+        high = min(following - timedelta(days=1), end).toordinal() - offset
+        result.append((period, prefix[high + 1] - prefix[low]))
+        period = following
+    return result
+
+
+def slot_label(slot):
+    """
+    Formats start of a day slot as HH:MM.
+    """
+    return '{:02d}:{:02d}'.format(*divmod(slot * SLOT_SECONDS // 60, 60))
+
+
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
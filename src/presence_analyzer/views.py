@@ -4,28 +4,79 @@ Defines views.
 """
 
 import calendar
+import json
 import locale
 import logging
+import os
+import tempfile
 from collections import OrderedDict
+from datetime import datetime
 from operator import itemgetter
 
-from flask import abort, redirect, request
+from flask import Response, abort, redirect, request, url_for
 from flask.ext.mako import render_template
 from mako.exceptions import TopLevelLookupException
+from werkzeug.wsgi import ClosingIterator
 
+from presence_analyzer.admission import admission
+from presence_analyzer.avatars import avatar_etag, get_avatar, image_mimetype
+from presence_analyzer.datasets import add_dataset_rules
+from presence_analyzer.events import get_notifier
 from presence_analyzer.main import app
+from presence_analyzer.memory import memory_report
 from presence_analyzer.utils import (
-    get_data,
-    group_by_weekday,
+    CACHE_BACKENDS,
+    get_company_rollup,
+    get_company_start_end_percentiles,
+    get_data_quality,
+    get_occupancy,
+    get_schedule_vectors,
+    get_user_start_end_percentiles,
+    get_user_trend_rollup,
+    get_user_weekdays,
     get_users_from_xml,
-    group_start_end_by_weekday,
     jsonify,
-    mean,
-    sum_intervals
+    present_at,
+    similar_users,
+    slot_label,
+    sum_intervals,
+    trend,
+    TREND_GRANULARITIES,
+    USER_NOT_FOUND_ENVIRON_KEY
 )
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
-locale.setlocale(locale.LC_COLLATE, '')
+
+EVENTS_HEARTBEAT = 15
+EVENTS_RETRY = 10
+AVATAR_MAX_AGE = 7 * 24 * 3600
+
+PERCENTILES_HEADER = (
+    'Weekday', 'Median start', 'Median end', 'P90 start', 'P90 end'
+)
+
+
+def user_not_found(user_id):
+    """
+    Returns error of an unknown user and marks the request with it.
+
+    The response has 200 status code, the mark tells after-request hooks
+    not to count the request as a view of an existing user.
+    """
+    log.debug('User %s not found!', user_id)
+    request.environ[USER_NOT_FOUND_ENVIRON_KEY] = True
+    return {
+        'message': 'User {} not found!'.format(user_id),
+        'status': 404
+    }
+
+
+@app.before_first_request
+def setup_locale():
+    """
+    Sets collation locale used to sort users by name.
+    """
+    locale.setlocale(locale.LC_COLLATE, '')
 
 
 @app.route('/')
@@ -47,6 +98,8 @@ def template_renderer(template):
     context['pages']['mean_time_weekday'] = 'Presence mean time'
     context['pages']['presence_start_end'] = 'Presence start-end'
     context['pages']['weekly_mean_presence'] = 'Weekly presence'
+    context['pages']['presence_trend'] = 'Presence trend'
+    context['pages']['occupancy'] = 'Office occupancy'
     context['current_page'] = request.path.split('.')[0][1:]
     try:
         return render_template(template, args=context)
@@ -55,6 +108,7 @@ def template_renderer(template):
 
 
 @app.route('/api/v1/users', methods=['GET'])
+@admission
 @jsonify
 def users_view():
     """
@@ -65,100 +119,364 @@ def users_view():
         {
             'user_id': user_id,
             'name': data[user_id]['name'],
-            'avatar': data[user_id]['avatar']
+            'avatar': url_for('avatar_view', user_id=user_id)
         }
         for user_id in data
     ]
     return sorted(users, cmp=locale.strcoll, key=itemgetter('name'))
 
 
+@app.route('/api/v1/avatars/<int:user_id>', methods=['GET'])
+def avatar_view(user_id):
+    """
+    Serves thumbnail of user's avatar from the local cache.
+
+    Falls back to the intranet image when it cannot be fetched.
+    """
+    users = get_users_from_xml()
+    if user_id not in users:
+        abort(404)
+    url = users[user_id]['avatar']
+    try:
+        content = get_avatar(
+            url,
+            app.config.get('AVATAR_CACHE_DIR') or os.path.join(
+                tempfile.gettempdir(), 'presence_analyzer_avatars'
+            ),
+            app.config.get('AVATAR_CACHE_SIZE', 16 * 1024 * 1024)
+        )
+    except IOError:
+        log.warning('Cannot fetch avatar %s', url, exc_info=True)
+        return redirect(url)
+    response = Response(content, mimetype=image_mimetype(content))
+    response.set_etag(avatar_etag(content))
+    response.cache_control.public = True
+    response.cache_control.max_age = AVATAR_MAX_AGE
+    return response.make_conditional(request)
+
+
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@admission
 @jsonify
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return {
-            'message': 'User {} not found!'.format(user_id),
-            'status': 404
-        }
+    weekdays = get_user_weekdays(user_id)
+    if weekdays is None:
+        return user_not_found(user_id)
 
-    weekdays = group_by_weekday(data[user_id])
     return [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
+        (calendar.day_abbr[weekday], presence)
+        for weekday, presence in enumerate(weekdays['presence'])
     ]
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@admission
 @jsonify
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return {
-            'message': 'User {} not found!'.format(user_id),
-            'status': 404
-        }
+    weekdays = get_user_weekdays(user_id)
+    if weekdays is None:
+        return user_not_found(user_id)
 
-    weekdays = group_by_weekday(data[user_id])
     result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
+        (calendar.day_abbr[weekday], presence)
+        for weekday, presence in enumerate(weekdays['total_presence'])
     ]
     result.insert(0, ('Weekday', 'Presence (s)'))
     return result
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@admission
 @jsonify
 def presence_start_end_view(user_id):
     """
     Returns mean presence time in the office of a given user.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return {
-            'message': 'User {} not found!'.format(user_id),
-            'status': 404
-        }
+    weekdays = get_user_weekdays(user_id)
+    if weekdays is None:
+        return user_not_found(user_id)
 
-    weekdays = group_start_end_by_weekday(data[user_id])
     return [
-        (
-            calendar.day_abbr[weekday],
-            mean(intervals['start']),
-            mean(intervals['end'])
+        (calendar.day_abbr[weekday], start, end)
+        for weekday, (start, end) in enumerate(
+            zip(weekdays['start'], weekdays['end'])
         )
-        for weekday, intervals in enumerate(weekdays)
     ]
 
 
+@app.route(
+    '/api/v1/presence_start_end_percentiles/<int:user_id>', methods=['GET']
+)
+@admission
+@jsonify
+def presence_start_end_percentiles_view(user_id):
+    """
+    Returns median and 90th percentile of presence start and end of a given
+    user grouped by weekday.
+    """
+    percentiles = get_user_start_end_percentiles(user_id)
+    if percentiles is None:
+        return user_not_found(user_id)
+
+    result = [
+        (calendar.day_abbr[weekday],) + weekday_percentiles
+        for weekday, weekday_percentiles in enumerate(percentiles)
+    ]
+    result.insert(0, PERCENTILES_HEADER)
+    return result
+
+
 @app.route('/api/v1/weekly_mean_presence/<int:user_id>', methods=['GET'])
+@admission
 @jsonify
 def weekly_mean_presence_view(user_id):
     """
     Returns mean
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return {
-            'message': 'User {} not found!'.format(user_id),
-            'status': 404
-        }
+    weekdays = get_user_weekdays(user_id)
+    if weekdays is None:
+        return user_not_found(user_id)
 
-    weekdays = group_by_weekday(data[user_id])
-    worked_hours, off_hours = sum_intervals([mean(day) for day in weekdays])
+    worked_hours, off_hours = sum_intervals(weekdays['presence'])
     return [
         ['Activity', 'Total hours'],
         ['Worked hours', worked_hours],
         ['Off hours', off_hours],
     ]
+
+
+@app.route('/api/v1/trend/<int:user_id>', methods=['GET'])
+@admission(query_args=('granularity', 'start', 'end'))
+@jsonify
+def trend_view(user_id):
+    """
+    Returns presence hours of a given user per day, week or month.
+
+    Accepts `granularity`, `start` and `end` (YYYY-MM-DD) query arguments.
+    """
+    granularity = request.args.get('granularity', 'week')
+    try:
+        if granularity not in TREND_GRANULARITIES:
+            raise ValueError(granularity)
+        start, end = [
+            datetime.strptime(request.args[name], '%Y-%m-%d').date()
+            if request.args.get(name) else None
+            for name in ('start', 'end')
+        ]
+    except ValueError:
+        log.debug('Invalid trend arguments %s', request.args)
+        return {
+            'message': 'Invalid trend arguments!',
+            'status': 400
+        }
+
+    rollup = get_user_trend_rollup(user_id)
+    if rollup is None:
+        return user_not_found(user_id)
+
+    result = [
+        (period.isoformat(), round(seconds / 3600.0, 2))
+        for period, seconds in trend(
+            rollup, granularity, start, end
+        )
+    ]
+    result.insert(0, ('Period', 'Presence (h)'))
+    return result
+
+
+@app.route('/api/v1/similar/<int:user_id>', methods=['GET'])
+@admission(query_args=('k',))
+@jsonify
+def similar_users_view(user_id):
+    """
+    Returns users with office hours most similar to a given user.
+
+    Accepts `k` query argument, number of returned users (5 by default).
+    """
+    vectors = get_schedule_vectors()
+    if user_id not in vectors['users']:
+        return user_not_found(user_id)
+
+    count = request.args.get('k', 5, type=int)
+    users = get_users_from_xml()
+    return [
+        {
+            'user_id': similar_id,
+            'name': users.get(similar_id, {}).get('name', str(similar_id)),
+            'similarity': round(similarity, 4),
+        }
+        for similar_id, similarity in similar_users(vectors, user_id, count)
+    ]
+
+
+@app.route('/api/v1/company/mean_time_weekday', methods=['GET'])
+@admission
+@jsonify
+def company_mean_time_weekday_view():
+    """
+    Returns mean presence time of all users grouped by weekday.
+    """
+    rollup = get_company_rollup()
+    return [
+        (calendar.day_abbr[weekday], mean_presence)
+        for weekday, mean_presence in enumerate(rollup['mean_presence'])
+    ]
+
+
+@app.route('/api/v1/company/start_end_distribution', methods=['GET'])
+@admission
+@jsonify
+def company_start_end_distribution_view():
+    """
+    Returns numbers of arrivals and departures of all users per time slot.
+    """
+    rollup = get_company_rollup()
+    result = [
+        (slot_label(slot), arrivals, departures)
+        for slot, (arrivals, departures) in enumerate(
+            zip(rollup['arrivals'], rollup['departures'])
+        )
+    ]
+    result.insert(0, ('Time', 'Arrivals', 'Departures'))
+    return result
+
+
+@app.route('/api/v1/company/start_end_percentiles', methods=['GET'])
+@admission
+@jsonify
+def company_start_end_percentiles_view():
+    """
+    Returns median and 90th percentile of presence start and end of all
+    users grouped by weekday.
+    """
+    result = [
+        (calendar.day_abbr[weekday],) + percentiles
+        for weekday, percentiles in enumerate(
+            get_company_start_end_percentiles()
+        )
+    ]
+    result.insert(0, PERCENTILES_HEADER)
+    return result
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@admission
+@jsonify
+def occupancy_view():
+    """
+    Returns mean number of people in the office per weekday and time slot.
+    """
+    heatmap = get_occupancy()['heatmap']
+    result = [
+        (slot_label(slot),) + tuple(weekday[slot] for weekday in heatmap)
+        for slot in xrange(len(heatmap[0]))
+    ]
+    result.insert(0, ('Time',) + tuple(calendar.day_abbr))
+    return result
+
+
+@app.route('/api/v1/occupancy/<string:moment>', methods=['GET'])
+@admission
+@jsonify
+def occupancy_at_view(moment):
+    """
+    Returns users present in the office at given moment (YYYY-MM-DDTHH:MM).
+    """
+    try:
+        moment = datetime.strptime(moment, '%Y-%m-%dT%H:%M')
+    except ValueError:
+        log.debug('Invalid moment %s', moment)
+        return {
+            'message': 'Invalid moment {}!'.format(moment),
+            'status': 400
+        }
+
+    users = get_users_from_xml()
+    return [
+        {
+            'user_id': user_id,
+            'name': users.get(user_id, {}).get('name', str(user_id)),
+        }
+        for user_id in present_at(get_occupancy(), moment)
+    ]
+
+
+@app.route('/api/v1/data_quality', methods=['GET'])
+@admission
+@jsonify
+def data_quality_view():
+    """
+    Returns counters of skipped, rejected and duplicated presence rows.
+    """
+    return get_data_quality()
+
+
+@app.route('/api/v1/cache_stats', methods=['GET'])
+@jsonify
+def cache_stats_view():
+    """
+    Returns hit, miss, set and error counters of used cache backends.
+    """
+    return {url: backend.stats for url, backend in CACHE_BACKENDS.items()}
+
+
+@app.route('/api/v1/events', methods=['GET'])
+def events_view():
+    """
+    Streams server-sent events about new generations of data and users.
+
+    Every stream holds a worker thread, at most EVENTS_MAX_STREAMS are
+    served at once. Further clients get an empty stream telling them to
+    reconnect later, EventSource gives up on error status codes.
+    """
+    notifier = get_notifier()
+    seen = request.headers.get('Last-Event-ID', type=int)
+    if seen is None:
+        seen = notifier.sequence
+    retry = 'retry: {}\n\n'.format(EVENTS_RETRY * 1000)
+    if not notifier.open_stream(app.config.get('EVENTS_MAX_STREAMS', 16)):
+        log.warning('Too many event streams')
+        return Response(
+            retry,
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache'}
+        )
+
+    def stream(seen):  # pylint: disable=missing-docstring
+        yield retry
+        while True:
+            events = notifier.wait(seen, EVENTS_HEARTBEAT)
+            if not events:
+                yield ': heartbeat\n\n'
+            for seen, name, generation in events:
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                    seen, name, json.dumps({'generation': generation})
+                )
+
+    return Response(
+        ClosingIterator(stream(seen), notifier.close_stream),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'}
+    )
+
+
+@app.route('/api/v1/memory', methods=['GET'])
+@jsonify
+def memory_view():
+    """
+    Returns memory taken by loaded data, indexes and cache entries.
+
+    Available only if MEMORY_REPORT setting is enabled.
+    """
+    if not app.config.get('MEMORY_REPORT'):
+        abort(404)
+    return memory_report()
+
+
+add_dataset_rules(app)
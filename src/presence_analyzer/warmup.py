@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Warm-up of a freshly started worker.
+"""
+
+import logging
+import os
+import time
+from functools import partial
+
+from flask_mako import _lookup
+
+from presence_analyzer import hot, utils, views
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def compile_templates(app):
+    """
+    Compiles all page templates with the lookup used for rendering.
+    """
+    lookup = _lookup(app)
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    names = sorted(
+        name for name in os.listdir(template_dir) if name.endswith('.html')
+    )
+    for name in names:
+        lookup.get_template(name)
+    return names
+
+
+def warm_up(app, import_times=()):
+    """
+    Loads data, builds indexes and compiles templates before serving.
+
+    Logs and returns list of (stage, seconds) tuples, `import_times`
+    measured by the caller are reported first. With LAZY_LOADING setting
+    only the offset index is built, the whole data is left unloaded.
+    Results of users saved in HOT_USERS_FILE are prewarmed too.
+    """
+    timings = list(import_times)
+    if app.config.get('LAZY_LOADING'):
+        data_stages = [('offset index', utils.get_offset_index)]
+    else:
+        data_stages = [
+            ('data', utils.get_data),
+            ('company rollup', utils.get_company_rollup),
+            ('percentile sketches', utils.get_company_start_end_sketches),
+            ('occupancy', utils.get_occupancy),
+            ('trend rollups', utils.get_trend_rollups),
+        ]
+    stages = [('locale', views.setup_locale)] + data_stages + [
+        ('users', utils.get_users_from_xml),
+        ('templates', partial(compile_templates, app)),
+    ]
+    if app.config.get('HOT_USERS_FILE'):
+        stages.append(('hot users', partial(hot.prewarm_hot_users, app)))
+    for name, stage in stages:
+        start = time.time()
+        stage()
+        timings.append((name, time.time() - start))
+
+    for name, seconds in timings:
+        log.info('Warm-up %-30s %9.1f ms', name, seconds * 1000)
+    log.info(
+        'Warm-up %-30s %9.1f ms', 'total',
+        sum(seconds for _, seconds in timings) * 1000
+    )
+    return timings